@@ -1,5 +1,13 @@
 import pandas as pd
 import numpy as np
+import csv
+import glob
+import os
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime
 
 #this function makes a header used in later functions
 def header():
@@ -32,6 +40,104 @@ def load_raw_tables():
     intake = import_data('/Users/nothing/Documents/data_analyst_portfolio/austin_animal_center/csv/Austin_Animal_Center_Intakes.csv', 'intake')
     outcome = import_data('/Users/nothing/Documents/data_analyst_portfolio/austin_animal_center/csv/Austin_Animal_Center_Outcomes.csv', 'outcome')
     return intake, outcome
+
+def raw_animal_keys(df) -> pd.Series:
+    # raw exports use "Animal ID"; normalize the same way the cleaned tables and sql/ joins do
+    column = [c for c in df.columns if c.strip().lower().replace(' ', '_') == 'animal_id'][0]
+    return df[column].astype(str).str.strip().str.lower()
+
+def raw_first_seen(df) -> pd.DataFrame:
+    # species and year of each animal's first record in a raw table
+    columns = {c.strip().lower().replace(' ', '_'): c for c in df.columns}
+    dt = df[columns['datetime']].astype(str)
+    if dt.str.contains(r'AM|PM', case = False, regex = True).any():
+        dt = pd.to_datetime(dt, format = '%m/%d/%Y %I:%M:%S %p', errors = 'coerce')
+    else:
+        dt = pd.to_datetime(dt, format = '%Y-%m-%d %H:%M:%S', errors = 'coerce')
+    first = pd.DataFrame({
+        'animal_key': raw_animal_keys(df),
+        'datetime': dt,
+        'spp': df[columns['animal_type']].astype(str).str.strip().str.lower()
+    })
+    first = first.sort_values('datetime').drop_duplicates(subset = 'animal_key', keep = 'first')
+    first['year'] = first['datetime'].dt.year.fillna(-1).astype(int)
+    return first[['animal_key', 'spp', 'year']]
+
+def sample_raw_tables(intake, outcome, fraction, stratify = False, seed = 0) -> tuple:
+    """
+    Keep a deterministic fraction of animals, with all of their intakes and outcomes.
+
+    Animals are chosen by hashing the normalized animal_id (salted by seed), so
+    the same animals are kept on every run and every intake keeps its outcomes,
+    which create_los_table and create_animal_table rely on. With stratify, the
+    lowest-hash ceil(fraction * n) animals are kept in each species x first-seen
+    year stratum, so small strata are never dropped entirely.
+
+    Returns the sampled intake and outcome tables plus a scaling table: the
+    number of animals and sampled animals per stratum (or one 'all' row) and
+    the scale_factor to multiply sampled counts by.
+    """
+    header()
+    print(f'Beginning to sample {fraction:.2%} of animals (stratified: {stratify}, seed: {seed})')
+    animals = (pd.concat([raw_first_seen(intake), raw_first_seen(outcome)], ignore_index = True)
+               .drop_duplicates(subset = 'animal_key', keep = 'first')
+               .reset_index(drop = True))
+    hash_key = f'{seed:016d}'[-16:]
+    animals['hash'] = pd.util.hash_pandas_object(animals['animal_key'], index = False, hash_key = hash_key).to_numpy() / 2.0 ** 64
+
+    strata = ['spp', 'year'] if stratify else []
+    if stratify:
+        rank = animals.groupby(strata)['hash'].rank(method = 'first')
+        size = animals.groupby(strata)['hash'].transform('size')
+        animals['sampled'] = rank <= np.ceil(fraction * size)
+        scaling = animals.groupby(strata)['sampled'].agg(n_animals = 'size', n_sampled = 'sum').reset_index()
+    else:
+        animals['sampled'] = animals['hash'] < fraction
+        scaling = pd.DataFrame({'stratum': ['all'], 'n_animals': [len(animals)], 'n_sampled': [animals['sampled'].sum()]})
+    scaling['scale_factor'] = scaling['n_animals'] / scaling['n_sampled'].where(scaling['n_sampled'] > 0)
+
+    kept = set(animals.loc[animals['sampled'], 'animal_key'])
+    intake = intake[raw_animal_keys(intake).isin(kept)].copy()
+    outcome = outcome[raw_animal_keys(outcome).isin(kept)].copy()
+
+    print(f'...kept {len(kept)} of {len(animals)} animals: {len(intake)} intakes, {len(outcome)} outcomes')
+    print(f'...overall scale factor {len(animals) / max(len(kept), 1):.2f}')
+    print('...complete')
+    return intake, outcome, scaling
+
+def scale_aggregate(df, count_cols, scaling, by = None) -> pd.DataFrame:
+    # estimate full-history counts from a sampled run; `by` maps df columns onto the scaling strata
+    df = df.copy()
+    overall = scaling['n_animals'].sum() / scaling['n_sampled'].sum()
+    if by is None:
+        factor = overall
+    else:
+        strata = scaling.rename(columns = {stratum: column for column, stratum in by.items()})
+        strata = strata.groupby(list(by))[['n_animals', 'n_sampled']].sum()
+        factor = df[list(by)].merge(
+            (strata['n_animals'] / strata['n_sampled']).rename('scale_factor').reset_index(),
+            on = list(by), how = 'left'
+        )['scale_factor']
+        # values without a stratum of their own (e.g. species missing on open stays) use the overall factor
+        factor = factor.fillna(overall).to_numpy()
+    df['scale_factor'] = factor
+    for column in count_cols:
+        df[f'{column}_scaled'] = df[column] * factor
+    return df
+
+def scale_by_species(df, count_cols, scaling, spp_col = 'cln_spp') -> pd.DataFrame:
+    # species split out of the raw 'other' animal type were sampled within the 'other' stratum
+    if 'spp' not in scaling.columns:
+        return scale_aggregate(df, count_cols, scaling)
+    raw_spp = df[spp_col].where(~df[spp_col].isin(list(OTHER_SPECIES_BREEDS) + ['unknown']), 'other')
+    return scale_aggregate(df.assign(raw_spp = raw_spp), count_cols, scaling, by = {'raw_spp': 'spp'}).drop(columns = 'raw_spp')
+
+def sample_artifact_name(file_name, fraction = None, seed = 0) -> str:
+    # artifacts from sampled runs get their own name so a full run never picks them up
+    if not fraction:
+        return file_name
+    stem, extension = os.path.splitext(file_name)
+    return f'{stem}_sample{fraction:g}_seed{seed}{extension}'
     
 def create_intake_table(df) -> pd.DataFrame:
     header()
@@ -118,7 +224,8 @@ def create_animal_table(animal_in, animal_out) -> pd.DataFrame:
     count_dups = merged_df['animal_id'].duplicated().sum()
     print(f'\nThere are {count_dups} duplicated animal_id values in the merged animal table.')
     animal_table = merged_df[['animal_id', 'cln_name_outcome', 'cln_spp_outcome', 'primary_breed_intake', 'secondary_breed_intake', 'akc_group_outcome', 'hair_length_outcome', 
-                              'cln_color_intake', 'altered_outcome', 'cln_sex_outcome', 'age_yr_outcome', 'lifecycle_stage_outcome']].copy()
+                              'cln_color_intake', 'altered_outcome', 'cln_sex_outcome', 'age_yr_outcome', 'lifecycle_stage_outcome',
+                              'primary_breed_outcome', 'base_color_intake']].copy()
     
     animal_table = clean_data(animal_table)
     
@@ -212,6 +319,19 @@ def datetime_y_lineid(df, df_name) -> pd.DataFrame:
         print(e)
         return None
 
+SEASON_MONTHS = {
+    'spring': [3, 4, 5],
+    'summer': [6, 7, 8],
+    'autumn': [9, 10, 11],
+    'winter': [12, 1, 2]
+}
+# [start hour, end hour)
+SHIFT_HOURS = {
+    'day': (7, 16),
+    'swing': (16, 24),
+    'overnight': (0, 7)
+}
+
 def datetime_extraction(df, df_name) -> pd.DataFrame:
     header()
     print(f'Beginning to extract from datetime in {df_name}')
@@ -237,27 +357,23 @@ def datetime_extraction(df, df_name) -> pd.DataFrame:
     df['year_quarter'] = df['year'].astype(str) + '-Q' + df['quarter'].astype(str)
 
     # season
-    season_conditions = [
-        df['month'].isin([3, 4, 5]),
-        df['month'].isin([6, 7, 8]),
-        df['month'].isin([9, 10, 11]),
-        df['month'].isin([12, 1, 2])
-    ]
-    season_choices = ['spring', 'summer', 'autumn', 'winter']
+    season_conditions = [df['month'].isin(months) for months in SEASON_MONTHS.values()]
+    season_choices = list(SEASON_MONTHS)
     df['season'] = np.select(season_conditions, season_choices, default='unknown')
 
     # shift
-    shift_conditions = [
-        (df['hour'] >= 7) & (df['hour'] < 16),
-        (df['hour'] >= 16) & (df['hour'] <= 23),
-        (df['hour'] >= 0) & (df['hour'] < 7)
-    ]
-    shift_choices = ['day', 'swing', 'overnight']
+    shift_conditions = [(df['hour'] >= start) & (df['hour'] < end) for start, end in SHIFT_HOURS.values()]
+    shift_choices = list(SHIFT_HOURS)
     df['shift'] = np.select(shift_conditions, shift_choices, default='unknown')
 
     print('...complete')
     return df
 
+MEDICAL_CONDITIONS = ['sick', 'injured', 'medical', 'aged']
+BEHAVIOR_CONDITIONS = ['feral', 'behavior']
+REPRODUCTIVE_CONDITIONS = ['pregnant', 'nursing']
+ROUTINE_CONDITIONS = ['normal']
+
 def intake_condition_clean(df, df_name) -> pd.DataFrame:
     header()
     print(f'\n\n\nunique conditions in {df_name}: {df['intake_condition'].unique()}')
@@ -265,17 +381,12 @@ def intake_condition_clean(df, df_name) -> pd.DataFrame:
     print(f'\n\n\nBeginning to clean up the condition list and condense to 3 catagorical values')
     #time.sleep(2)
 
-    medical_conditions = ['sick', 'injured', 'medical', 'aged']
-    behavior_conditions = ['feral', 'behavior']
-    reproductive_conditions = ['pregnant', 'nursing']
-    routine_conditions = ['normal']
-
-    df['pregnant_o_nursing'] = np.where(df['intake_condition'].isin(reproductive_conditions), True, False)
+    df['pregnant_o_nursing'] = np.where(df['intake_condition'].isin(REPRODUCTIVE_CONDITIONS), True, False)
 
     conditions = [
-        df['intake_condition'].isin(medical_conditions) | df['intake_condition'].isin(reproductive_conditions),
-        df['intake_condition'].isin(behavior_conditions),
-        df['intake_condition'].isin(routine_conditions)
+        df['intake_condition'].isin(MEDICAL_CONDITIONS) | df['intake_condition'].isin(REPRODUCTIVE_CONDITIONS),
+        df['intake_condition'].isin(BEHAVIOR_CONDITIONS),
+        df['intake_condition'].isin(ROUTINE_CONDITIONS)
     ]
 
     choices = [
@@ -288,19 +399,19 @@ def intake_condition_clean(df, df_name) -> pd.DataFrame:
     print('...complete')
     return df
 
+UNKNOWN_OUTCOMES = ['nan', 'missing']
+ALIVE_OUTCOMES = ['rto-adopt', 'adoption', 'return to owner']
+ADMINISTRATIVE_OUTCOMES = ['transfer', 'relocate']
+DECEASED_OUTCOMES = ['euthanasia', 'died', 'disposal']
+
 def clean_outcome_type(df, df_name) -> pd.DataFrame:
     print(f'Beginning to clean {df_name}')
     
-    unknown_outcome = ['nan', 'missing']
-    alive_outcome = ['rto-adopt', 'adoption', 'return to owner']
-    administrative_outcome = ['transfer', 'relocate']
-    deceased_outcome = ['euthanasia', 'died', 'disposal']
-    
     conditions = [
-        df['outcome_type'].isin(unknown_outcome),
-        df['outcome_type'].isin(alive_outcome),
-        df['outcome_type'].isin(administrative_outcome),
-        df['outcome_type'].isin(deceased_outcome)
+        df['outcome_type'].isin(UNKNOWN_OUTCOMES),
+        df['outcome_type'].isin(ALIVE_OUTCOMES),
+        df['outcome_type'].isin(ADMINISTRATIVE_OUTCOMES),
+        df['outcome_type'].isin(DECEASED_OUTCOMES)
     ]
 
     choices = [
@@ -314,22 +425,22 @@ def clean_outcome_type(df, df_name) -> pd.DataFrame:
     print('...complete')
     return df
 
+LOCATION_SUBTYPES = ['in kennel', 'offsite', 'at vet', 'barn', 'enroute', 'in surgery'] #the animal's specific physical location or temporary status
+BEHAVIOR_SUBTYPES = ['suffering', 'medical', 'aggressive', 'rabies risk', 'behavior'] #indicates the reason for a specific outcome (often euthanasia or specialized treatment)
+PROGRAM_SUBTYPES = ['partner', 'underage', 'foster', 'in foster', 'snr', 'scrp', 'prc'] #subtypes related to specific shelter programs or transfer partners
+ADMIN_SUBTYPES = ['field', 'possible theft', 'customer s', 'court/investigation', 'emer'] #Miscellaneous or administrative details
+UNKNOWN_SUBTYPES = ['nan']
+
 def clean_outcome_subtype(df, df_name) -> pd.DataFrame:
     header()
     print(f'Beginning to clean {df_name}')
 
-    location_subtype = ['in kennel', 'offsite', 'at vet', 'barn', 'enroute', 'in surgery'] #the animal's specific physical location or temporary status
-    behavior_subtype = ['suffering', 'medical', 'aggressive', 'rabies risk', 'behavior'] #indicates the reason for a specific outcome (often euthanasia or specialized treatment)
-    program_subtype = ['partner', 'underage', 'foster', 'in foster', 'snr', 'scrp', 'prc'] #subtypes related to specific shelter programs or transfer partners
-    admin_subtype = ['field', 'possible theft', 'customer s', 'court/investigation', 'emer'] #Miscellaneous or administrative details
-    unknown_subtype = ['nan']
-
     conditions = [
-        df['outcome_subtype'].isin(location_subtype),
-        df['outcome_subtype'].isin(behavior_subtype),
-        df['outcome_subtype'].isin(program_subtype),
-        df['outcome_subtype'].isin(admin_subtype),
-        df['outcome_subtype'].isin(unknown_subtype)
+        df['outcome_subtype'].isin(LOCATION_SUBTYPES),
+        df['outcome_subtype'].isin(BEHAVIOR_SUBTYPES),
+        df['outcome_subtype'].isin(PROGRAM_SUBTYPES),
+        df['outcome_subtype'].isin(ADMIN_SUBTYPES),
+        df['outcome_subtype'].isin(UNKNOWN_SUBTYPES)
     ]
 
     choices = [
@@ -597,6 +708,34 @@ def clean_cat_breed_group(df, breed_col='primary_breed', spp_col='cln_spp'):
     return df
 
 
+# primary_breed values of animal_type 'other' -> species group, first match wins
+OTHER_SPECIES_BREEDS = {
+    'rabbit': [
+        'polish', 'rabbit sh', 'ringtail', 'californian', 'lionhead', 'dutch', 
+        'angora-french', 'lop-holland', 'angora-satin', 'rex', 'rhinelander', 
+        'havana', 'new zealand wht', 'netherlnd dwarf', 'lop-english', 
+        'english spot', 'rabbit lh', 'cinnamon', 'american', 'hotot', 
+        'lop-amer fuzzy', 'lop-mini', 'checkered giant', 'american sable', 
+        'flemish giant', 'harlequin', 'chinchilla-stnd', 'rex-mini', 
+        'jersey wooly', 'silver', 'cottontail', 'britannia petit', 'beveren', 
+        'dwarf hotot', 'himalayan', 'angora-english', 'belgian hare'
+    ],
+    'rodent_small_pet': [
+        'guinea pig', 'ferret', 'chinchilla', 'hamster', 'rat', 'mouse', 
+        'hedgehog', 'gerbil', 'sugar glider', 'prairie dog', 'chinchilla-amer'
+    ],
+    'reptile_amphibian': [
+        'snake', 'lizard', 'tortoise', 'turtle', 'frog'
+    ],
+    'arthropod_aquatic': [
+        'tarantula', 'hermit crab', 'cold water', 'tropical'
+    ],
+    'wildlife': [
+        'raccoon', 'opossum', 'bat', 'fox', 'squirrel', 'skunk', 'armadillo', 
+        'coyote', 'otter', 'deer', 'bobcat'
+    ]
+}
+
 def clean_spp(df) -> pd.DataFrame:
     header2()
     try:
@@ -608,45 +747,8 @@ def clean_spp(df) -> pd.DataFrame:
         other = df['cln_spp'] == 'other'
         #print(df.loc[other]['primary_breed'].unique())
 
-        rabbit_list = [
-            'polish', 'rabbit sh', 'ringtail', 'californian', 'lionhead', 'dutch', 
-            'angora-french', 'lop-holland', 'angora-satin', 'rex', 'rhinelander', 
-            'havana', 'new zealand wht', 'netherlnd dwarf', 'lop-english', 
-            'english spot', 'rabbit lh', 'cinnamon', 'american', 'hotot', 
-            'lop-amer fuzzy', 'lop-mini', 'checkered giant', 'american sable', 
-            'flemish giant', 'harlequin', 'chinchilla-stnd', 'rex-mini', 
-            'jersey wooly', 'silver', 'cottontail', 'britannia petit', 'beveren', 
-            'dwarf hotot', 'himalayan', 'angora-english', 'belgian hare'
-        ]
-        rodent_small_pet_list = [
-            'guinea pig', 'ferret', 'chinchilla', 'hamster', 'rat', 'mouse', 
-            'hedgehog', 'gerbil', 'sugar glider', 'prairie dog', 'chinchilla-amer'
-        ]
-        reptile_amphibian_list = [
-            'snake', 'lizard', 'tortoise', 'turtle', 'frog'
-        ]
-        arthropod_aquatic_list = [
-            'tarantula', 'hermit crab', 'cold water', 'tropical'
-        ]
-        wildlife_list  = [
-            'raccoon', 'opossum', 'bat', 'fox', 'squirrel', 'skunk', 'armadillo', 
-            'coyote', 'otter', 'deer', 'bobcat'
-        ]
-
-        conditions = [
-            df.loc[other, 'primary_breed'].isin(rabbit_list),
-            df.loc[other, 'primary_breed'].isin(rodent_small_pet_list),
-            df.loc[other, 'primary_breed'].isin(reptile_amphibian_list),
-            df.loc[other, 'primary_breed'].isin(arthropod_aquatic_list),
-            df.loc[other, 'primary_breed'].isin(wildlife_list)
-        ]
-        choices = [
-            'rabbit',
-            'rodent_small_pet',
-            'reptile_amphibian',
-            'arthropod_aquatic',
-            'wildlife'
-        ]
+        conditions = [df.loc[other, 'primary_breed'].isin(breeds) for breeds in OTHER_SPECIES_BREEDS.values()]
+        choices = list(OTHER_SPECIES_BREEDS)
         df.loc[other, 'cln_spp'] = np.select(conditions, choices, default = 'unknown')
 
         #print(df.head(50))
@@ -665,6 +767,48 @@ def clean_spp(df) -> pd.DataFrame:
         print(f'Error: {e}')
         return df
 
+# dog primary_breed values by AKC group, first match wins
+AKC_GROUP_BREEDS = {
+    'toy': (
+        'affenpinscher', 'cavalier span', 'chihuahua longhair', 'chihuahua shorthair', 'chinese crested', 'entlebucher', 'havanese', 'italian greyhound', 'jack russell terrier', 'japanese chin', 'maltese', 
+        'manchester terrier', 'miniature pinscher', 'miniature poodle', 'papillon', 'pekingese', 'pomeranian', 'pug', 'shih tzu', 'silky terrier', 'toy fox terrier', 'toy poodle', 'yorkshire terrier'
+    ),
+    'hound': (
+        'afghan hound' , 'american eskimo', 'american foxhound', 'basenji', 'basset hound', 'beagle', 'black mouth cur', 'bloodhound', 'blue lacy', 'bluetick hound', 'dachshund', 'dachshund longhair', 
+        'dachshund stan', 'dachshund wirehair', 'english foxhound', 'english pointer', 'greyhound', 'harrier', 'ibizan hound', 'irish wolfhound', 'norwegian elkhound', 'otterhound', 'pharaoh hound',
+        'picardy sheepdog', 'pit bull', 'plott hound', 'podengo pequeno', 'redbone hound', 'rhod ridgeback', 'saluki', 'treeing walker coonhound', 'whippet'
+    ),
+    'terrier': (
+        'airedale terrier', 'akbash', 'american staffordshire terrier', 'australian terrier', 'border terrier', 'bull terrier', 'bull terrier miniature', 'cairn terrier', 'chesa bay retr', 
+        'irish terrier', 'lakeland terrier', 'miniature schnauzer', 'norfolk terrier', 'norwich terrier', 'parson russell terrier', 'patterdale terr', 'pbgv', 'rat terrier', 'scottish terrier',
+        'sealyham terr', 'skye terrier', 'smooth fox terrier', 'soft coated wheaten terrier', 'standard poodle', 'welsh terrier', 'west highland', 'wire hair fox terrier'
+    ),
+    'working': (
+        'akita', 'alaskan husky', 'alaskan klee kai', 'alaskan malamute', 'bernese mountain dog', 'boerboel', 'boxer', 'boykin span', 'bullmastiff', 'cane corso', 'dogo argentino', 'dogue de bordeaux', 
+        'german pinscher', 'german shepherd', 'glen of imaal', 'great dane', 'great pyrenees', 'greater swiss mountain dog', 'kuvasz', 'leonberger', 'mastiff', 'mexican hairless', 'neapolitan mastiff',
+        'newfoundland', 'presa canario', 'rottweiler', 'samoyed', 'siberian husky', 'standard schnauzer', 'sussex span', 'tibetan mastiff'
+    ),
+    'foundation': (
+        'american bulldog', 'american pit bull terrier', 'australian kelpie', 'bruss griffon', 'carolina dog', 'catahoula', 'doberman pinsch', 'dutch sheepdog', 'feist', 'hovawart', 'jindo', 'kangal', 
+        'port water dog', 'spanish mastiff', 'staffordshire', 'treeing cur', 'treeing tennesse brindle'
+    ),
+    'sporting': (
+        'anatol shepherd', 'brittany', 'clumber spaniel', 'cocker spaniel', 'english cocker spaniel', 'english coonhound', 'english setter', 'english shepherd', 'english springer spaniel', 
+        'field spaniel', 'german wirehaired pointer', 'golden retriever', 'gordon setter', 'grand basset griffon vendeen', 'irish setter', 'labrador retriever', 'nova scotia duck tolling retriever',
+        'old english bulldog', 'pointer', 'spinone italiano', 'st. bernard rough coat', 'st. bernard smooth coat', 'vizsla', 'weimaraner', 'welsh springer spaniel', 'wirehaired pointing griffon',
+        'wolf hybrid'
+    ),
+    'herding': (
+        'australian cattle dog', 'australian shepherd', 'bearded collie', 'beauceron', 'bedlington terr', 'belgian malinois', 'belgian sheepdog', 'belgian tervuren', 'border collie', 'briard', 
+        'canaan dog', 'cardigan welsh corgi', 'collie rough', 'collie smooth', 'german shorthair pointer', 'old english sheepdog', 'pembroke welsh corgi', 'queensland heeler', 'shetland sheepdog',
+        'spanish water dog', 'swedish vallhund', 'swiss hound'
+    ),
+    'non_sporting': (
+        'bichon frise', 'boston terrier', 'bouv flandres', 'bulldog', 'chinese sharpei', 'chow chow', 'coton de tulear', 'dalmatian', 'dandie dinmont', 'finnish spitz', 'flat coat retriever', 
+        'french bulldog', 'keeshond', 'lhasa apso', 'lowchen', 'schipperke', 'schnauzer giant', 'shiba inu', 'tibetan spaniel', 'tibetan terrier'
+    )
+}
+
 def akc_groups(df) -> pd.DataFrame:
     header()
     print('Beginning to identify dog breeds by AKC group')
@@ -672,49 +816,8 @@ def akc_groups(df) -> pd.DataFrame:
     dogs = df['cln_spp'].str.contains('dog')
     #print(f'unique dog breeds: \n {df.loc[dogs, "primary_breed"].unique()}')
 
-    toy = ('affenpinscher', 'cavalier span', 'chihuahua longhair', 'chihuahua shorthair', 'chinese crested', 'entlebucher', 'havanese', 'italian greyhound', 'jack russell terrier', 'japanese chin', 'maltese', 
-           'manchester terrier', 'miniature pinscher', 'miniature poodle', 'papillon', 'pekingese', 'pomeranian', 'pug', 'shih tzu', 'silky terrier', 'toy fox terrier', 'toy poodle', 'yorkshire terrier')
-    hound = ('afghan hound' , 'american eskimo', 'american foxhound', 'basenji', 'basset hound', 'beagle', 'black mouth cur', 'bloodhound', 'blue lacy', 'bluetick hound', 'dachshund', 'dachshund longhair', 
-             'dachshund stan', 'dachshund wirehair', 'english foxhound', 'english pointer', 'greyhound', 'harrier', 'ibizan hound', 'irish wolfhound', 'norwegian elkhound', 'otterhound', 'pharaoh hound', 
-             'picardy sheepdog', 'pit bull', 'plott hound', 'podengo pequeno', 'redbone hound', 'rhod ridgeback', 'saluki', 'treeing walker coonhound', 'whippet')
-    terrier = ('airedale terrier', 'akbash', 'american staffordshire terrier', 'australian terrier', 'border terrier', 'bull terrier', 'bull terrier miniature', 'cairn terrier', 'chesa bay retr', 
-               'irish terrier', 'lakeland terrier', 'miniature schnauzer', 'norfolk terrier', 'norwich terrier', 'parson russell terrier', 'patterdale terr', 'pbgv', 'rat terrier', 'scottish terrier', 
-               'sealyham terr', 'skye terrier', 'smooth fox terrier', 'soft coated wheaten terrier', 'standard poodle', 'welsh terrier', 'west highland', 'wire hair fox terrier')
-    working = ('akita', 'alaskan husky', 'alaskan klee kai', 'alaskan malamute', 'bernese mountain dog', 'boerboel', 'boxer', 'boykin span', 'bullmastiff', 'cane corso', 'dogo argentino', 'dogue de bordeaux', 
-               'german pinscher', 'german shepherd', 'glen of imaal', 'great dane', 'great pyrenees', 'greater swiss mountain dog', 'kuvasz', 'leonberger', 'mastiff', 'mexican hairless', 'neapolitan mastiff', 
-               'newfoundland', 'presa canario', 'rottweiler', 'samoyed', 'siberian husky', 'standard schnauzer', 'sussex span', 'tibetan mastiff')
-    foundation = ('american bulldog', 'american pit bull terrier', 'australian kelpie', 'bruss griffon', 'carolina dog', 'catahoula', 'doberman pinsch', 'dutch sheepdog', 'feist', 'hovawart', 'jindo', 'kangal', 
-                  'port water dog', 'spanish mastiff', 'staffordshire', 'treeing cur', 'treeing tennesse brindle')
-    sporting = ('anatol shepherd', 'brittany', 'clumber spaniel', 'cocker spaniel', 'english cocker spaniel', 'english coonhound', 'english setter', 'english shepherd', 'english springer spaniel', 
-                'field spaniel', 'german wirehaired pointer', 'golden retriever', 'gordon setter', 'grand basset griffon vendeen', 'irish setter', 'labrador retriever', 'nova scotia duck tolling retriever', 
-                'old english bulldog', 'pointer', 'spinone italiano', 'st. bernard rough coat', 'st. bernard smooth coat', 'vizsla', 'weimaraner', 'welsh springer spaniel', 'wirehaired pointing griffon', 
-                'wolf hybrid')
-    herding = ('australian cattle dog', 'australian shepherd', 'bearded collie', 'beauceron', 'bedlington terr', 'belgian malinois', 'belgian sheepdog', 'belgian tervuren', 'border collie', 'briard', 
-               'canaan dog', 'cardigan welsh corgi', 'collie rough', 'collie smooth', 'german shorthair pointer', 'old english sheepdog', 'pembroke welsh corgi', 'queensland heeler', 'shetland sheepdog', 
-               'spanish water dog', 'swedish vallhund', 'swiss hound')
-    non_sporting = ('bichon frise', 'boston terrier', 'bouv flandres', 'bulldog', 'chinese sharpei', 'chow chow', 'coton de tulear', 'dalmatian', 'dandie dinmont', 'finnish spitz', 'flat coat retriever', 
-                    'french bulldog', 'keeshond', 'lhasa apso', 'lowchen', 'schipperke', 'schnauzer giant', 'shiba inu', 'tibetan spaniel', 'tibetan terrier')
-    conditions = [
-        df.loc[dogs, 'primary_breed'].isin(toy),
-        df.loc[dogs, 'primary_breed'].isin(hound),
-        df.loc[dogs, 'primary_breed'].isin(terrier),
-        df.loc[dogs, 'primary_breed'].isin(working),
-        df.loc[dogs, 'primary_breed'].isin(foundation),
-        df.loc[dogs, 'primary_breed'].isin(sporting),
-        df.loc[dogs, 'primary_breed'].isin(herding),
-        df.loc[dogs, 'primary_breed'].isin(non_sporting)
-    ]           
-
-    choices = [
-        'toy',
-        'hound',
-        'terrier',
-        'working',
-        'foundation',
-        'sporting',
-        'herding',
-        'non_sporting'
-    ]
+    conditions = [df.loc[dogs, 'primary_breed'].isin(breeds) for breeds in AKC_GROUP_BREEDS.values()]
+    choices = list(AKC_GROUP_BREEDS)
 
     df.loc[dogs, 'akc_group'] = np.select(conditions, choices, default = 'unknown')
     print('...complete')
@@ -774,6 +877,7 @@ def clean_color(df) -> pd.DataFrame:
         print('Beginning to clean color column')
         df['cln_color'] = df['color'].astype(str).str.split('/', n = 1).str[0].str.strip().str.lower()
         df['secondary_color'] = df['color'].astype(str).str.split('/', n = 1).str[1].str.strip().str.lower()
+        df['base_color'] = df['cln_color']  # before pattern condensing, kept for mapping lineage
         df.loc[df['cln_color'] == 'pink', 'cln_color'] = 'unknown'
         print('...condensing patterned colors')
         df = patterned(df)
@@ -786,12 +890,12 @@ def clean_color(df) -> pd.DataFrame:
         print(f'Error: {e}')
         return df 
 
-def patterned(df) -> pd.DataFrame:
-    pattern_list = [
-     'tabby', 'tiger', 'calico', 'tortie', 'torbie', 'brindle', 'tricolor', 'tri-color', 'tri color', 'tick', 'merle', 'point', 'lynx'
-    ]
+COLOR_PATTERNS = [
+    'tabby', 'tiger', 'calico', 'tortie', 'torbie', 'brindle', 'tricolor', 'tri-color', 'tri color', 'tick', 'merle', 'point', 'lynx'
+]
 
-    pattern_regex = '|'.join(pattern_list)
+def patterned(df) -> pd.DataFrame:
+    pattern_regex = '|'.join(COLOR_PATTERNS)
 
     is_patterned = df['cln_color'].str.contains(pattern_regex, case=False, regex=True)
     df.loc[is_patterned, 'cln_color'] = 'patterned'
@@ -827,7 +931,10 @@ def clean_animal_dimension(df) -> pd.DataFrame:
         'altered_outcome',
         'cln_sex_outcome',
         'age_yr_outcome',
-        'lifecycle_stage_outcome'
+        'lifecycle_stage_outcome',
+        # source values of mapped columns, used to recompute them when a mapping changes
+        'primary_breed_outcome',
+        'base_color_intake'
     ]
     return df[keep_cols].copy()
 
@@ -866,7 +973,1464 @@ def export_tables(intake_df, outcome_df, animal_df, los_df) -> None:
     outcome_df.to_csv('outcome_table.csv', index = False)
     animal_df.to_csv('animal_table.csv', index = False)
     los_df.to_csv('length_of_stay_table.csv', index = False)
-    print('...export complete') 
+    print('...export complete')
+
+def los_sketch_points(los_df, animal_df) -> pd.DataFrame:
+    # one single-weight centroid per stay, keyed by species x life stage x intake month
+    points = los_df[['animal_id', 'datetime_intake', 'length_of_stay_days']].merge(
+        animal_df[['animal_id', 'cln_spp_outcome', 'lifecycle_stage_outcome']],
+        on = 'animal_id',
+        how = 'left'
+    )
+    points = points.dropna(subset = ['length_of_stay_days'])
+
+    return pd.DataFrame({
+        # animals without an outcome carry the string 'nan' from clean_data, which would not survive a CSV round trip
+        'cln_spp': points['cln_spp_outcome'].replace('nan', np.nan).fillna('unknown').astype(str),
+        'lifecycle_stage': points['lifecycle_stage_outcome'].replace('nan', np.nan).fillna('unknown').astype(str),
+        'month': points['datetime_intake'].dt.strftime('%Y-%m').fillna('unknown'),
+        'mean': points['length_of_stay_days'].astype(float),
+        'weight': 1.0
+    })
+
+def compress_sketches(centroids, compression = 100) -> pd.DataFrame:
+    """
+    Merge centroids into t-digest style sketches, one per sketch key.
+
+    All groups are compressed in a single vectorized pass: centroids are sorted
+    by value within each group, placed on the k1 scale function
+    k(q) = compression / (2 * pi) * arcsin(2q - 1) and any centroids landing in
+    the same unit of k are combined into one weighted centroid. Buckets are
+    narrow near the tails, so extreme percentiles stay accurate.
+
+    Because input may be raw points or previously compressed centroids, the same
+    function builds, merges and incrementally updates sketches.
+
+    Parameters
+    ----------
+    centroids : pandas.DataFrame
+        Sketch key columns plus 'mean' and 'weight'.
+    compression : int
+        Accuracy knob; each sketch keeps at most about compression / 2 + 1 centroids.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Compressed centroids with the same columns.
+    """
+    keys = [c for c in centroids.columns if c not in ('mean', 'weight')]
+    df = centroids.sort_values(keys + ['mean']).reset_index(drop = True)
+
+    grouped = df.groupby(keys, sort = False)['weight']
+    total = grouped.transform('sum')
+    q_mid = (grouped.cumsum() - df['weight'] / 2) / total
+    k = compression / (2 * np.pi) * np.arcsin(np.clip(2 * q_mid - 1, -1, 1))
+    df['bucket'] = np.floor(k - k.min()).astype(int)
+
+    df['weighted'] = df['mean'] * df['weight']
+    merged = df.groupby(keys + ['bucket'], sort = False)[['weighted', 'weight']].sum().reset_index()
+    merged['mean'] = merged['weighted'] / merged['weight']
+
+    return merged[keys + ['mean', 'weight']].sort_values(keys + ['mean']).reset_index(drop = True)
+
+def build_los_sketches(los_df, animal_df, compression = 100) -> pd.DataFrame:
+    header()
+    print('Beginning to build length of stay quantile sketches')
+    sketches = compress_sketches(los_sketch_points(los_df, animal_df), compression)
+    print(f'...{len(sketches)} centroids across '
+          f'{sketches[["cln_spp", "lifecycle_stage", "month"]].drop_duplicates().shape[0]} sketches')
+    print('...complete')
+    return sketches
+
+def merge_los_sketches(*sketches, compression = 100) -> pd.DataFrame:
+    # partitions and incremental runs combine by concatenating centroids and re-compressing
+    return compress_sketches(pd.concat(sketches, ignore_index = True), compression)
+
+def update_los_sketches(file_name, new_los_df, animal_df, compression = 100) -> pd.DataFrame:
+    # only pass stays not already folded into the saved sketches, or they will be double counted
+    new_sketches = build_los_sketches(new_los_df, animal_df, compression)
+    try:
+        existing = pd.read_csv(file_name, dtype = {'month': str})
+        print(f'...merging with {len(existing)} saved centroids from {file_name}')
+        sketches = merge_los_sketches(existing, new_sketches, compression = compression)
+    except FileNotFoundError:
+        print(f'No saved sketches at {file_name}, starting fresh')
+        sketches = new_sketches
+
+    sketches.to_csv(file_name, index = False)
+    return sketches
+
+def index_los_sketches(sketches) -> dict:
+    # (cln_spp, lifecycle_stage, month) -> (cumulative weight midpoints, centroid means, total weight)
+    index = {}
+    for key, group in sketches.groupby(['cln_spp', 'lifecycle_stage', 'month'], sort = False):
+        weights = group['weight'].to_numpy()
+        index[key] = (np.cumsum(weights) - weights / 2, group['mean'].to_numpy(), weights.sum())
+    return index
+
+def sketch_quantile(entry, q):
+    cum_mid, means, total = entry
+    return float(np.interp(q * total, cum_mid, means))
+
+def index_los_slices(sketches, compression = 100) -> dict:
+    """
+    Index sketches by (cln_spp, lifecycle_stage) for slice queries.
+
+    Each entry holds the monthly centroids (months, means, weights) plus the
+    cell's months already merged into one sketch, so queries over all months
+    only touch a few dozen centroids per cell.
+    """
+    all_months = compress_sketches(sketches.drop(columns = 'month'), compression)
+    merged = {key: (group['mean'].to_numpy(), group['weight'].to_numpy())
+              for key, group in all_months.groupby(['cln_spp', 'lifecycle_stage'], sort = False)}
+
+    index = {}
+    for key, group in sketches.groupby(['cln_spp', 'lifecycle_stage'], sort = False):
+        index[key] = (group['month'].to_numpy(dtype = str), group['mean'].to_numpy(), group['weight'].to_numpy()) + merged[key]
+    return index
+
+def los_quantile(slices, q, cln_spp = None, lifecycle_stage = None, months = None):
+    """
+    Estimate a length of stay percentile (0 <= q <= 1) for any slice of the sketches.
+
+    slices is the output of index_los_slices(); build it once and reuse it. Filters
+    left as None cover every value. The selected centroids are not re-compressed:
+    they are sorted by mean and the percentile is interpolated over their
+    cumulative weights, which keeps a query in the microsecond range. Queries
+    over all months use each cell's pre-merged sketch.
+    """
+    if isinstance(slices, pd.DataFrame):
+        slices = index_los_slices(slices)
+    if isinstance(months, str):
+        months = [months]
+
+    means, weights = [], []
+    for (spp, stage), (cell_months, cell_means, cell_weights, merged_means, merged_weights) in slices.items():
+        if (cln_spp is not None and spp != cln_spp) or (lifecycle_stage is not None and stage != lifecycle_stage):
+            continue
+        if months is None:
+            cell_means, cell_weights = merged_means, merged_weights
+        else:
+            keep = np.isin(cell_months, months)
+            cell_means, cell_weights = cell_means[keep], cell_weights[keep]
+        means.append(cell_means)
+        weights.append(cell_weights)
+
+    if not means or sum(len(m) for m in means) == 0:
+        return np.nan
+    means, weights = np.concatenate(means), np.concatenate(weights)
+    order = np.argsort(means, kind = 'stable')
+    means, weights = means[order], weights[order]
+    return sketch_quantile((np.cumsum(weights) - weights / 2, means, weights.sum()), q)
+
+def row_dimensions(df) -> pd.DataFrame:
+    """
+    Species, life stage, AKC group and hair length of each intake or outcome row.
+
+    Uses the row's own animal_type, breed and age_upon_* columns, cleaned the same
+    way create_animal_table cleans them, so animals still in care are described as
+    they were at intake rather than by an outcome they do not have yet. Cleaning
+    runs once per distinct combination. The result has the same index as df.
+    """
+    age_col = [c for c in df.columns if c.startswith('age_upon')][0]
+    source_cols = ['animal_type', 'breed', age_col]
+    combos = df[source_cols].drop_duplicates().reset_index(drop = True)
+    dimensions = (combos.copy()
+                  .pipe(clean_age)
+                  .pipe(lifecycle)
+                  .pipe(clean_breed)
+                  .pipe(clean_spp)
+                  .pipe(akc_groups)
+                  .pipe(hair_length))
+    dimension_cols = ['cln_spp', 'lifecycle_stage', 'akc_group', 'hair_length']
+    combos[dimension_cols] = dimensions[dimension_cols]
+
+    rows = df[source_cols].merge(combos, on = source_cols, how = 'left')[dimension_cols]
+    rows.index = df.index
+    return rows
+
+def create_stay_table(intake_df, outcome_df, as_of = None) -> pd.DataFrame:
+    """
+    Pair every intake with its earliest outcome at or after the intake, keeping open stays.
+
+    Uses the same pairing rule as create_los_table, but intakes with no outcome yet
+    are kept as censored stays measured up to as_of (defaults to the latest
+    datetime in either table).
+    """
+    header()
+    print('Beginning to create stay table (including open stays)')
+
+    stays = (intake_df[['animal_id', 'datetime', 'intake_reason', 'year']]
+             .assign(intake_row = intake_df.index)
+             .dropna(subset = ['datetime'])
+             .rename(columns = {'datetime': 'datetime_intake'})
+             .sort_values('datetime_intake'))
+    outcomes = (outcome_df[['animal_id', 'datetime', 'outcome_category']]
+                .dropna(subset = ['datetime'])
+                .rename(columns = {'datetime': 'datetime_outcome'})
+                .sort_values('datetime_outcome'))
+
+    stays = pd.merge_asof(
+        stays, outcomes,
+        left_on = 'datetime_intake',
+        right_on = 'datetime_outcome',
+        by = 'animal_id',
+        direction = 'forward'
+    )
+
+    if as_of is None:
+        as_of = max(intake_df['datetime'].max(), outcome_df['datetime'].max())
+
+    stays['event'] = stays['datetime_outcome'].notna()
+    end = stays['datetime_outcome'].fillna(as_of)
+    stays['duration_days'] = (end - stays['datetime_intake']).dt.days.clip(lower = 0)
+
+    print(f'...{(~stays["event"]).sum()} open stays censored at {as_of}')
+    print('...complete')
+    return stays
+
+def survival_inputs(stays, intake_df, cohort_cols) -> pd.DataFrame:
+    # cohorts use species and life stage at intake, so open stays land in their species cohort
+    dimensions = row_dimensions(intake_df)[['cln_spp', 'lifecycle_stage']]
+    df = stays.merge(dimensions, left_on = 'intake_row', right_index = True, how = 'left')
+
+    for column in cohort_cols:
+        if df[column].dtype == 'object':
+            df[column] = df[column].replace('nan', np.nan).fillna('unknown')
+    return df
+
+def sorted_event_table(df, cohort_cols, categories = None):
+    """
+    Collapse stays into one row per (cohort, duration) using sorted arrays.
+
+    Returns the cohort labels plus a dict of numpy arrays aligned on the unique
+    (cohort, duration) pairs: cohort code, duration, number at risk, events,
+    censored and, when categories is given, an events-by-category matrix.
+    """
+    grouper = df.groupby(cohort_cols, dropna = False)
+    labels = grouper.size().reset_index()[cohort_cols]
+    codes = grouper.ngroup().to_numpy()
+    durations = df['duration_days'].to_numpy()
+    events = df['event'].to_numpy()
+
+    order = np.lexsort((durations, codes))
+    codes, durations, events = codes[order], durations[order], events[order]
+
+    is_new = np.r_[True, (codes[1:] != codes[:-1]) | (durations[1:] != durations[:-1])]
+    starts = np.flatnonzero(is_new)
+
+    table = {
+        'cohort': codes[starts],
+        'duration_days': durations[starts],
+        # rows from this time to the end of the cohort block are still at risk
+        'n_at_risk': np.searchsorted(codes, codes[starts], side = 'right') - starts,
+        'events': np.add.reduceat(events.astype(int), starts),
+    }
+    table['censored'] = np.diff(np.r_[starts, len(codes)]) - table['events']
+
+    if categories is not None:
+        category = df['outcome_category'].to_numpy()[order]
+        hits = np.column_stack([(category == c) & events for c in categories]).astype(int)
+        table['events_by_category'] = np.add.reduceat(hits, starts, axis = 0)
+
+    return labels, table
+
+def segmented_cumsum(values, cohort):
+    # cumulative sum restarting at each cohort block (cohort must be sorted)
+    totals = np.cumsum(values, axis = 0)
+    first = np.flatnonzero(np.r_[True, cohort[1:] != cohort[:-1]])
+    block = np.cumsum(np.r_[True, cohort[1:] != cohort[:-1]]) - 1
+    return totals - (totals[first] - values[first])[block]
+
+def first_time_reached(reached, cohort, durations, n_cohorts):
+    # earliest duration per cohort where `reached` is true, NaN when never reached
+    result = np.full(n_cohorts, np.nan)
+    hit_cohorts, first_hit = np.unique(cohort[reached], return_index = True)
+    result[hit_cohorts] = durations[reached][first_hit]
+    return result
+
+def km_survival(table):
+    # product-limit survival at and just before each (cohort, duration), as a segmented log-cumsum
+    hazard = table['events'] / table['n_at_risk']
+    log_step = np.log1p(-np.minimum(hazard, 0.5))
+    log_step[hazard < 1] = np.log1p(-hazard[hazard < 1])
+    cumulative = segmented_cumsum(log_step, table['cohort'])
+
+    survival = np.exp(cumulative)
+    # a hazard of 1 can only happen at a cohort's last time, where everyone left has an outcome
+    survival[hazard >= 1] = 0.0
+    return survival, np.exp(cumulative - log_step)
+
+def kaplan_meier_curves(df, cohort_cols):
+    labels, table = sorted_event_table(df, cohort_cols)
+
+    survival, _ = km_survival(table)
+
+    curves = labels.iloc[table['cohort']].reset_index(drop = True)
+    for column in ['duration_days', 'n_at_risk', 'events', 'censored']:
+        curves[column] = table[column]
+    curves['survival'] = survival
+
+    medians = labels.copy()
+    medians['n_stays'] = df.groupby(cohort_cols, dropna = False).size().to_numpy()
+    medians['n_open'] = medians['n_stays'] - df.groupby(cohort_cols, dropna = False)['event'].sum().to_numpy()
+    medians['median_days'] = first_time_reached(survival <= 0.5 + 1e-9, table['cohort'], table['duration_days'], len(labels))
+
+    return curves, medians
+
+def competing_risk_curves(df, cohort_cols, categories = ('alive', 'admin', 'deceased', 'unknown')):
+    """
+    Cumulative incidence of each outcome category (Aalen-Johansen), with open stays censored.
+
+    Each category's incidence rarely reaches 50%, so per-category medians are
+    reported conditionally: the time by which half of that category's eventual
+    outcomes have happened.
+    """
+    categories = list(categories)
+    labels, table = sorted_event_table(df, cohort_cols, categories)
+
+    cohort = table['cohort']
+    _, survival_before = km_survival(table)
+
+    increments = survival_before[:, None] * table['events_by_category'] / table['n_at_risk'][:, None]
+    incidence = segmented_cumsum(increments, cohort)
+
+    n_rows = len(cohort)
+    cif = labels.iloc[np.repeat(cohort, len(categories))].reset_index(drop = True)
+    cif['outcome_category'] = np.tile(categories, n_rows)
+    cif['duration_days'] = np.repeat(table['duration_days'], len(categories))
+    cif['cumulative_incidence'] = incidence.ravel()
+
+    last = np.flatnonzero(np.r_[cohort[1:] != cohort[:-1], True])
+    final = incidence[last]
+    summaries = []
+    for i, category in enumerate(categories):
+        summary = labels.copy()
+        summary['outcome_category'] = category
+        summary['final_incidence'] = final[:, i]
+        reached = (incidence[:, i] >= final[cohort, i] / 2 - 1e-9) & (final[cohort, i] > 0)
+        summary['conditional_median_days'] = first_time_reached(reached, cohort, table['duration_days'], len(labels))
+        summaries.append(summary)
+
+    return cif, pd.concat(summaries, ignore_index = True)
+
+def create_survival_tables(intake_df, outcome_df, cohort_cols = None, as_of = None) -> dict:
+    header()
+    print('Beginning Kaplan-Meier time-to-outcome estimates')
+    if cohort_cols is None:
+        cohort_cols = ['cln_spp', 'lifecycle_stage', 'intake_reason', 'year']
+
+    stays = survival_inputs(create_stay_table(intake_df, outcome_df, as_of), intake_df, cohort_cols)
+    km_curves, km_medians = kaplan_meier_curves(stays, cohort_cols)
+    cif_curves, cif_medians = competing_risk_curves(stays, cohort_cols)
+
+    print(f'...{len(km_medians)} cohorts over {len(stays)} stays')
+    if 'cln_spp' in cohort_cols:
+        open_by_spp = km_medians.groupby('cln_spp')['n_open'].sum()
+        print(f'...open stays by species: {open_by_spp[open_by_spp > 0].to_dict()}')
+    print(km_medians.head())
+    print('...complete')
+    return {
+        'km_curves': km_curves,
+        'km_medians': km_medians,
+        'cif_curves': cif_curves,
+        'cif_medians': cif_medians
+    }
+
+FEATURE_WINDOWS = (7, 28, 365)
+INTAKE_REASONS = ['medical', 'behavior', 'routine', 'Unknown']
+OUTCOME_CATEGORIES = ['alive', 'admin', 'deceased', 'unknown']
+SHIFTS = ['day', 'swing', 'overnight']
+
+def daily_counts(intake_df, outcome_df, start = None) -> pd.DataFrame:
+    # one row per (date, cln_spp) with intake/outcome counts broken out by category and shift;
+    # species comes from each row itself, so a stored day never changes when an animal later leaves
+    frames = []
+    sources = [
+        (intake_df, 'intake', [('intake_reason', INTAKE_REASONS, 'intake_'), ('shift', SHIFTS, 'intake_shift_')]),
+        (outcome_df, 'outcome', [('outcome_category', OUTCOME_CATEGORIES, 'outcome_')])
+    ]
+    for df, prefix, breakdowns in sources:
+        events = df.assign(date = df['datetime'].dt.normalize()).dropna(subset = ['date'])
+        if start is not None:
+            events = events[events['date'] >= start]
+        events['cln_spp'] = row_dimensions(events)['cln_spp'].replace('nan', np.nan).fillna('unknown')
+
+        counts = events.groupby(['date', 'cln_spp']).size().rename(f'{prefix}_total').to_frame()
+        for column, values, label in breakdowns:
+            split = (pd.crosstab([events['date'], events['cln_spp']], events[column])
+                     .reindex(columns = values, fill_value = 0)
+                     .rename(columns = lambda value: f'{label}{value}'.lower()))
+            counts = counts.join(split)
+        frames.append(counts)
+
+    return pd.concat(frames, axis = 1).fillna(0).astype(int).reset_index()
+
+def build_daily_features(counts) -> pd.DataFrame:
+    """
+    Add rolling sums, same-week-last-year baselines and mix columns to daily counts.
+
+    Counts are pivoted to one column per (feature, species) on a complete daily
+    index, so every rolling window and shift runs once over the whole frame
+    instead of per species. Windows need full history (NaN until then), which
+    keeps incremental runs identical to a full rebuild.
+    """
+    header()
+    print('Beginning to build daily intake/outcome features')
+    count_cols = [c for c in counts.columns if c not in ('date', 'cln_spp')]
+
+    wide = counts.set_index(['date', 'cln_spp'])[count_cols].unstack('cln_spp', fill_value = 0)
+    wide = wide.asfreq('D', fill_value = 0)
+
+    parts = {'': wide}
+    for window in FEATURE_WINDOWS:
+        parts[f'_{window}d'] = wide.rolling(window, min_periods = window).sum()
+    # 52 weeks back keeps the weekday aligned
+    parts['_7d_last_year'] = parts['_7d'].shift(364)
+
+    features = pd.concat(
+        [part.rename(columns = lambda c: f'{c}{suffix}', level = 0) for suffix, part in parts.items()],
+        axis = 1
+    )
+    features = features.stack('cln_spp', future_stack = True).reset_index()
+    features = features.rename(columns = {'level_0': 'date'})
+
+    for shift in SHIFTS:
+        features[f'intake_shift_{shift}_share'] = (
+            features[f'intake_shift_{shift}'] / features['intake_total'].where(features['intake_total'] > 0)
+        )
+    features['intake_total_vs_last_year'] = features['intake_total_7d'] - features['intake_total_7d_last_year']
+
+    calendar = datetime_extraction(pd.DataFrame({'datetime': features['date']}), 'daily_features')
+    features[['year', 'month', 'week', 'weekday', 'is_weekend', 'season']] = (
+        calendar[['year', 'month', 'week', 'weekday', 'is_weekend', 'season']])
+
+    print(f'...{len(features)} daily rows for {features["cln_spp"].nunique()} species')
+    print('...complete')
+    return features
+
+def feature_partition_path(directory, year):
+    return f'{directory}/year={year}.csv'
+
+def feature_partition_years(directory) -> list:
+    paths = glob.glob(feature_partition_path(directory, '*'))
+    return sorted(int(path.rsplit('year=', 1)[1].split('.')[0]) for path in paths)
+
+def read_feature_partitions(directory, since = None) -> pd.DataFrame:
+    frames = []
+    for year in feature_partition_years(directory):
+        if since is None or year >= since.year:
+            frames.append(pd.read_csv(feature_partition_path(directory, year), parse_dates = ['date']))
+    if not frames:
+        return None
+    features = pd.concat(frames, ignore_index = True)
+    if since is not None:
+        features = features[features['date'] >= since]
+    return features
+
+def write_feature_partitions(features, directory) -> None:
+    os.makedirs(directory, exist_ok = True)
+    for year, part in features.groupby(features['date'].dt.year):
+        path = feature_partition_path(directory, year)
+        if os.path.exists(path):
+            # rows on or after the first new date are replaced
+            existing = pd.read_csv(path, parse_dates = ['date'])
+            part = pd.concat([existing[existing['date'] < part['date'].min()], part], ignore_index = True)
+        part.to_csv(path, index = False)
+        print(f'...wrote {len(part)} rows to {path}')
+
+def update_daily_features(directory, intake_df, outcome_df) -> pd.DataFrame:
+    """
+    Extend the on-disk daily feature store with days not yet written.
+
+    The last stored day is rebuilt as well, since it may have been partial. Only
+    enough stored history to fill the longest window and the last-year baseline
+    is re-read; the raw tables are only counted from the last stored day on.
+    """
+    header()
+    print(f'Beginning to update daily feature store in {directory}')
+    years = feature_partition_years(directory)
+    if not years:
+        print('No stored features found, building full history')
+        features = build_daily_features(daily_counts(intake_df, outcome_df))
+        write_feature_partitions(features, directory)
+        return features
+
+    last_day = pd.read_csv(feature_partition_path(directory, years[-1]), parse_dates = ['date'])['date'].max()
+    lookback = pd.Timedelta(days = max(FEATURE_WINDOWS) + 364 + 7)
+    history = read_feature_partitions(directory, since = last_day - lookback)
+    history = history[history['date'] < last_day]
+
+    new_counts = daily_counts(intake_df, outcome_df, start = last_day)
+    count_cols = [c for c in new_counts.columns if c not in ('date', 'cln_spp')]
+    counts = pd.concat([history[['date', 'cln_spp'] + count_cols], new_counts], ignore_index = True)
+
+    features = build_daily_features(counts)
+    features = features[features['date'] >= last_day]
+    print(f'...{features["date"].nunique()} new or refreshed days since {last_day.date()}')
+    write_feature_partitions(features, directory)
+    return features
+
+SCORING_FEATURES = ['cln_spp', 'lifecycle_stage', 'intake_reason', 'akc_group', 'hair_length', 'season', 'shift']
+LOS_BUCKET_BINS = [-np.inf, 7, 30, 90, np.inf]
+LOS_BUCKET_LABELS = ['0-7 days', '8-30 days', '31-90 days', '90+ days']
+
+def scoring_frame(intake_df) -> pd.DataFrame:
+    # intake-time features, one row per intake in the same order as intake_df; nothing known only at outcome leaks in
+    features = intake_df[['animal_id', 'datetime', 'intake_reason', 'season', 'shift']].copy()
+    features[['cln_spp', 'lifecycle_stage', 'akc_group', 'hair_length']] = row_dimensions(intake_df)
+    return features
+
+def encode_features(features, vocab) -> np.ndarray:
+    """
+    Map each feature column to one-hot positions: an (n_rows, n_features) int array.
+
+    Each column gets its own block of positions with one slot reserved for values
+    not seen in training, so scoring is a gather-and-sum over the weight matrix.
+    """
+    encoded = np.empty((len(features), len(SCORING_FEATURES)), dtype = np.int64)
+    offset = 0
+    for j, column in enumerate(SCORING_FEATURES):
+        values = vocab[column]
+        codes = pd.Categorical(features[column].astype(str), categories = values).codes.astype(np.int64)
+        codes[codes < 0] = len(values)
+        encoded[:, j] = codes + offset
+        offset += len(values) + 1
+    return encoded
+
+def softmax(logits) -> np.ndarray:
+    logits = logits - logits.max(axis = 1, keepdims = True)
+    probs = np.exp(logits)
+    return probs / probs.sum(axis = 1, keepdims = True)
+
+def fit_softmax_regression(encoded, y, n_features, n_classes, l2 = 1e-3, iterations = 300, learning_rate = 0.5):
+    # L2-regularized multinomial logistic regression by full-batch gradient descent on one-hot codes
+    n_rows = len(y)
+    weights = np.zeros((n_features, n_classes))
+    bias = np.zeros(n_classes)
+    target = np.eye(n_classes)[y]
+    flat = encoded.ravel()
+
+    for _ in range(iterations):
+        probs = softmax(weights[encoded].sum(axis = 1) + bias)
+        error = (probs - target) / n_rows
+        grad = np.column_stack([
+            np.bincount(flat, weights = np.repeat(error[:, k], encoded.shape[1]), minlength = n_features)
+            for k in range(n_classes)
+        ])
+        weights -= learning_rate * (grad + l2 * weights)
+        bias -= learning_rate * error.sum(axis = 0)
+
+    return weights, bias
+
+def scoring_training_frame(intake_df, outcome_df, features) -> pd.DataFrame:
+    # completed stays with their intake-time features (from scoring_frame) and both targets
+    stays = create_stay_table(intake_df, outcome_df)
+    stays = stays[stays['event']].rename(columns = {'datetime_intake': 'datetime'})
+    training = features.merge(
+        stays[['animal_id', 'datetime', 'outcome_category', 'duration_days']],
+        on = ['animal_id', 'datetime'],
+        how = 'inner'
+    )
+    training['los_bucket'] = pd.cut(training['duration_days'], LOS_BUCKET_BINS, labels = LOS_BUCKET_LABELS)
+    return training
+
+def scoring_vocab(features) -> dict:
+    # taken over every intake, open stays included, so the next run's intakes rarely bring new values
+    return {column: sorted(features[column].astype(str).unique()) for column in SCORING_FEATURES}
+
+def unseen_feature_values(features, vocab) -> dict:
+    unseen = {column: sorted(set(features[column].astype(str)) - set(vocab[column])) for column in SCORING_FEATURES}
+    return {column: values for column, values in unseen.items() if values}
+
+def train_scoring_model(intake_df, outcome_df, l2 = 1e-3, iterations = 300) -> dict:
+    header()
+    print('Beginning to train intake outcome / LOS scoring model')
+
+    features = scoring_frame(intake_df)
+    training = scoring_training_frame(intake_df, outcome_df, features)
+    print(f'...{len(training)} completed stays used for training')
+
+    vocab = scoring_vocab(features)
+    encoded = encode_features(training, vocab)
+    n_features = sum(len(values) + 1 for values in vocab.values())
+
+    model = {'vocab': vocab, 'training_cutoff': str(intake_df['datetime'].max())}
+    for target, classes in [('outcome_category', OUTCOME_CATEGORIES), ('los_bucket', LOS_BUCKET_LABELS)]:
+        y = pd.Categorical(training[target].astype(str), categories = classes).codes
+        keep = y >= 0
+        weights, bias = fit_softmax_regression(encoded[keep], y[keep], n_features, len(classes), l2, iterations)
+        accuracy = (softmax(weights[encoded[keep]].sum(axis = 1) + bias).argmax(axis = 1) == y[keep]).mean()
+        print(f'...{target}: training accuracy {accuracy:.3f}')
+        model[target] = {'classes': list(classes), 'weights': weights, 'bias': bias}
+
+    print('...complete')
+    return model
+
+def save_scoring_model(model, file_name) -> None:
+    arrays = {f'vocab__{column}': np.array(values) for column, values in model['vocab'].items()}
+    arrays['training_cutoff'] = np.array(model['training_cutoff'])
+    for target in ['outcome_category', 'los_bucket']:
+        for part in ['classes', 'weights', 'bias']:
+            arrays[f'{target}__{part}'] = np.array(model[target][part])
+    np.savez(file_name, **arrays)
+    print(f'...saved scoring model to {file_name}')
+
+def load_scoring_model(file_name) -> dict:
+    with np.load(file_name) as arrays:
+        model = {'vocab': {column: arrays[f'vocab__{column}'].tolist() for column in SCORING_FEATURES}}
+        # models saved without a training cutoff are retrained
+        model['training_cutoff'] = str(arrays['training_cutoff']) if 'training_cutoff' in arrays.files else None
+        for target in ['outcome_category', 'los_bucket']:
+            model[target] = {part: arrays[f'{target}__{part}'] for part in ['classes', 'weights', 'bias']}
+            model[target]['classes'] = model[target]['classes'].tolist()
+    return model
+
+def load_or_train_scoring_model(file_name, intake_df, outcome_df, max_age_days = 30, retrain = False, save = True) -> dict:
+    """
+    Reuse the model saved at file_name until it is max_age_days old; new intakes
+    are scored with it in the meantime.
+
+    A saved model is also retrained when the current intakes carry feature values
+    outside its vocabulary (e.g. after a mapping edit) or when this data ends
+    before the model's training cutoff, i.e. the model was trained on other data.
+    """
+    header()
+    if not retrain and os.path.exists(file_name):
+        age_days = (time.time() - os.path.getmtime(file_name)) / 86400
+        model = load_scoring_model(file_name)
+        if age_days > max_age_days:
+            print(f'Cached scoring model is {age_days:.0f} days old, retraining')
+        elif model['training_cutoff'] is None:
+            print('Cached scoring model has no training cutoff, retraining')
+        elif intake_df['datetime'].max() < pd.Timestamp(model['training_cutoff']):
+            print(f'Cached scoring model was trained on intakes up to {model["training_cutoff"]}, later than this data, retraining')
+        else:
+            unseen = unseen_feature_values(scoring_frame(intake_df), model['vocab'])
+            if unseen:
+                print(f'Cached scoring model has not seen {unseen}, retraining')
+            else:
+                print(f'Loading cached scoring model from {file_name} ({age_days:.1f} days old, trained on intakes up to {model["training_cutoff"]})')
+                return model
+
+    model = train_scoring_model(intake_df, outcome_df)
+    if save:
+        save_scoring_model(model, file_name)
+    return model
+
+def score_intakes(intake_df, model, batch_size = 1_000_000) -> pd.DataFrame:
+    header()
+    print(f'Beginning to score {len(intake_df)} intakes')
+    start = time.perf_counter()
+    encoded = encode_features(scoring_frame(intake_df), model['vocab'])
+
+    for target in ['outcome_category', 'los_bucket']:
+        classes = np.array(model[target]['classes'])
+        weights, bias = model[target]['weights'], model[target]['bias']
+        best = np.empty(len(encoded), dtype = np.int64)
+        best_prob = np.empty(len(encoded))
+        for batch_start in range(0, len(encoded), batch_size):
+            batch = slice(batch_start, batch_start + batch_size)
+            probs = softmax(weights[encoded[batch]].sum(axis = 1) + bias)
+            best[batch] = probs.argmax(axis = 1)
+            best_prob[batch] = probs.max(axis = 1)
+        intake_df[f'predicted_{target}'] = classes[best]
+        intake_df[f'predicted_{target}_prob'] = best_prob
+
+    elapsed = time.perf_counter() - start
+    print(f'...scored in {elapsed:.2f}s ({len(intake_df) / max(elapsed, 1e-9) * 60:,.0f} rows per minute)')
+    print('...complete')
+    return intake_df
+
+EVENT_TYPES = np.array(['intake', 'outcome'])
+
+def build_event_log(intake_df, outcome_df) -> dict:
+    """
+    Interleave intakes and outcomes into one columnar log sorted by (animal, datetime).
+
+    Returns a dict of numpy arrays. 'offsets' is CSR style: the events of the
+    animal at position i in 'animal_keys' are rows offsets[i]:offsets[i + 1], so
+    any animal's history is a slice once its position is known. Intakes sort
+    before outcomes that share a timestamp. Categorical columns are stored as
+    integer codes with a matching '<column>_values' lookup array.
+    """
+    header()
+    print('Beginning to build per-animal event log')
+    events = pd.concat([
+        pd.DataFrame({
+            'animal_id': intake_df['animal_id'].astype(str).str.lower(),
+            'datetime': intake_df['datetime'],
+            'event_type': 0,
+            'event_detail': intake_df['intake_type'].astype(str),
+            'event_category': intake_df['intake_reason'].astype(str)
+        }),
+        pd.DataFrame({
+            'animal_id': outcome_df['animal_id'].astype(str).str.lower(),
+            'datetime': outcome_df['datetime'],
+            'event_type': 1,
+            'event_detail': outcome_df['outcome_type'].astype(str),
+            'event_category': outcome_df['outcome_category'].astype(str)
+        })
+    ], ignore_index = True).dropna(subset = ['datetime'])
+
+    animal_codes, animal_keys = pd.factorize(events['animal_id'], sort = True)
+    datetimes = events['datetime'].to_numpy(dtype = 'datetime64[ns]')
+    event_types = events['event_type'].to_numpy(dtype = np.int8)
+    order = np.lexsort((event_types, datetimes, animal_codes))
+
+    log = {
+        'animal_keys': np.asarray(animal_keys, dtype = str),
+        'offsets': np.r_[0, np.cumsum(np.bincount(animal_codes, minlength = len(animal_keys)))].astype(np.int64),
+        'datetime': datetimes[order],
+        'event_type': event_types[order]
+    }
+    for column in ['event_detail', 'event_category']:
+        codes, values = pd.factorize(events[column])
+        log[column] = codes[order].astype(np.int32)
+        log[f'{column}_values'] = np.asarray(values, dtype = str)
+
+    print(f'...{len(log["datetime"])} events for {len(log["animal_keys"])} animals')
+    print('...complete')
+    return log
+
+def save_event_log(log, directory) -> None:
+    # one .npy file per array so other tools can np.load(..., mmap_mode = 'r') just the columns they need
+    os.makedirs(directory, exist_ok = True)
+    for name, values in log.items():
+        if not name.startswith('_'):
+            np.save(os.path.join(directory, f'{name}.npy'), values)
+    print(f'...event log saved to {directory}')
+
+def load_event_log(directory, mmap = True) -> dict:
+    log = {}
+    for path in glob.glob(os.path.join(directory, '*.npy')):
+        name = os.path.basename(path)[:-len('.npy')]
+        log[name] = np.load(path, mmap_mode = 'r' if mmap else None)
+    return log
+
+def animal_position(log, animal_id):
+    # built once per log, then every lookup is a dict hit
+    if '_positions' not in log:
+        log['_positions'] = {key: i for i, key in enumerate(log['animal_keys'].tolist())}
+    return log['_positions'].get(str(animal_id).lower())
+
+def animal_events(log, animal_id) -> slice:
+    position = animal_position(log, animal_id)
+    if position is None:
+        return slice(0, 0)
+    return slice(int(log['offsets'][position]), int(log['offsets'][position + 1]))
+
+def animal_history(log, animal_id) -> pd.DataFrame:
+    rows = animal_events(log, animal_id)
+    return pd.DataFrame({
+        'datetime': log['datetime'][rows],
+        'event_type': EVENT_TYPES[log['event_type'][rows]],
+        'event_detail': log['event_detail_values'][log['event_detail'][rows]],
+        'event_category': log['event_category_values'][log['event_category'][rows]]
+    })
+
+def latest_state(log, animal_id) -> dict:
+    rows = animal_events(log, animal_id)
+    if rows.start == rows.stop:
+        return None
+    last = rows.stop - 1
+    return {
+        'animal_id': str(animal_id).lower(),
+        'in_care': bool(log['event_type'][last] == 0),
+        'since': log['datetime'][last],
+        'last_event': str(EVENT_TYPES[log['event_type'][last]]),
+        'last_detail': str(log['event_detail_values'][log['event_detail'][last]]),
+        'n_events': rows.stop - rows.start
+    }
+
+def latest_states(log) -> pd.DataFrame:
+    # last event of every animal at once, e.g. to list everything currently in care
+    offsets = np.asarray(log['offsets'])
+    has_events = offsets[1:] > offsets[:-1]
+    last = offsets[1:][has_events] - 1
+    return pd.DataFrame({
+        'animal_id': np.asarray(log['animal_keys'])[has_events],
+        'in_care': np.asarray(log['event_type'])[last] == 0,
+        'since': np.asarray(log['datetime'])[last],
+        'n_events': (offsets[1:] - offsets[:-1])[has_events]
+    })
+
+def animal_journeys(log, animal_id) -> pd.DataFrame:
+    # each intake paired with the next event when that event is an outcome; open stays have no outcome
+    rows = animal_events(log, animal_id)
+    types = np.asarray(log['event_type'][rows])
+    datetimes = np.asarray(log['datetime'][rows])
+    details = log['event_detail_values'][log['event_detail'][rows]]
+
+    intakes = np.flatnonzero(types == 0)
+    following = intakes + 1
+    closed = following < len(types)
+    closed[closed] = types[following[closed]] == 1
+
+    journeys = pd.DataFrame({
+        'datetime_intake': datetimes[intakes],
+        'intake_type': details[intakes],
+        'datetime_outcome': pd.NaT,
+        'outcome_type': None
+    })
+    journeys.loc[closed, 'datetime_outcome'] = datetimes[following[closed]]
+    journeys.loc[closed, 'outcome_type'] = details[following[closed]]
+    journeys['length_of_stay_days'] = (journeys['datetime_outcome'] - journeys['datetime_intake']).dt.days
+    return journeys
+
+def linkage_records(intake_df, outcome_df) -> pd.DataFrame:
+    # one record per animal_id from its first intake, cleaned with the same steps as the animal table
+    header()
+    print('Beginning to build record linkage inputs')
+    first_intakes = intake_df.sort_values('datetime').drop_duplicates(subset = 'animal_id', keep = 'first')
+    records = (first_intakes
+               .filter(regex = r'^(animal_id|name|animal_type|sex.*|age.*|breed|color|datetime|found_location)$').copy()
+               .pipe(clean_name)
+               .pipe(clean_age)
+               .pipe(clean_sex)
+               .pipe(clean_breed)
+               .pipe(clean_spp)
+               .pipe(clean_color)
+               .reset_index(drop = True))
+
+    # "123 main st in austin (tx)" -> "austin (tx)"
+    records['found_area'] = (records['found_location'].astype(str)
+                             .str.rsplit(' in ', n = 1).str[-1].str.strip())
+    records['birth_year'] = (records['datetime'].dt.year + records['datetime'].dt.dayofyear / 365.25
+                             - records['age_yr'])
+    records['has_name'] = records['cln_name'] != records['animal_id'].astype(str)
+
+    last_seen = pd.concat([intake_df[['animal_id', 'datetime']], outcome_df[['animal_id', 'datetime']]])
+    last_seen = last_seen.groupby('animal_id')['datetime'].max().rename('last_seen')
+    records = records.merge(last_seen, on = 'animal_id', how = 'left')
+    records = records.rename(columns = {'datetime': 'first_seen'})
+    print('...complete')
+    return records
+
+def candidate_pairs(records, window = 10) -> pd.DataFrame:
+    """
+    Generate candidate pairs with blocking plus a sorted-neighborhood window.
+
+    Records are blocked on species, primary breed, primary color, sex, found area
+    and a two-year birth band, then sorted by name within each block and only
+    compared with the next `window` records. Candidates are therefore at most
+    n * window per pass, however large a block is. A second pass with the birth
+    bands shifted by a year catches pairs that straddle a band edge.
+    """
+    block_cols = ['cln_spp', 'primary_breed', 'cln_color', 'cln_sex', 'found_area']
+    pairs = []
+    for shift in [0, 1]:
+        band = np.floor((records['birth_year'] + shift) / 2).fillna(-1).astype(int)
+        block = records[block_cols].astype(str).assign(band = band).groupby(block_cols + ['band'], sort = False).ngroup()
+        order = np.lexsort((records['first_seen'].to_numpy(), records['cln_name'].astype(str).to_numpy(), block.to_numpy()))
+        block_sorted = block.to_numpy()[order]
+
+        for distance in range(1, window + 1):
+            left = np.arange(len(order) - distance)
+            right = left + distance
+            same_block = block_sorted[left] == block_sorted[right]
+            pairs.append(np.column_stack([order[left[same_block]], order[right[same_block]]]))
+
+    pairs = np.unique(np.sort(np.vstack(pairs), axis = 1), axis = 0)
+    print(f'...{len(pairs)} candidate pairs for {len(records)} records')
+    return pd.DataFrame(pairs, columns = ['left', 'right'])
+
+def score_pairs(records, pairs) -> pd.DataFrame:
+    left = records.iloc[pairs['left']].reset_index(drop = True)
+    right = records.iloc[pairs['right']].reset_index(drop = True)
+    scored = pd.DataFrame({'animal_id_a': left['animal_id'], 'animal_id_b': right['animal_id']})
+
+    # name: owner names are strong evidence, shelter-given (*) names weaker, conflicting owner names count against
+    both_named = left['has_name'] & right['has_name']
+    same_name = both_named & (left['cln_name'] == right['cln_name'])
+    similar_name = both_named & (left['cln_name'].str[:3] == right['cln_name'].str[:3])
+    shelter_given = left['name_given_at_intake'] | right['name_given_at_intake']
+    scored['name_score'] = np.select(
+        [same_name & ~shelter_given, same_name, similar_name, both_named & ~shelter_given],
+        [2.0, 1.0, 0.5, -1.0],
+        default = 0.0
+    )
+
+    # age: estimated birth dates should agree
+    birth_gap = (left['birth_year'] - right['birth_year']).abs()
+    scored['age_score'] = np.select([birth_gap <= 0.5, birth_gap <= 1.5, birth_gap.notna()], [1.5, 0.5, -2.0], default = 0.0)
+
+    # timing: one animal cannot be in two stays at once; a return within a year is likely
+    earlier_last = np.where(left['first_seen'] <= right['first_seen'], left['last_seen'], right['last_seen'])
+    later_first = np.where(left['first_seen'] <= right['first_seen'], right['first_seen'], left['first_seen'])
+    gap_days = (pd.Series(later_first) - pd.Series(earlier_last)).dt.days
+    scored['timing_score'] = np.select([gap_days < 0, gap_days <= 365], [-3.0, 1.0], default = 0.0)
+
+    scored['score'] = scored[['name_score', 'age_score', 'timing_score']].sum(axis = 1)
+    return scored
+
+def link_clusters(animal_ids, links) -> pd.DataFrame:
+    # connected components by repeated min-label propagation over the link edges
+    ids = pd.Index(animal_ids)
+    a = ids.get_indexer(links['animal_id_a'])
+    b = ids.get_indexer(links['animal_id_b'])
+    labels = np.arange(len(ids))
+    while True:
+        edge_min = np.minimum(labels[a], labels[b])
+        updated = labels.copy()
+        np.minimum.at(updated, a, edge_min)
+        np.minimum.at(updated, b, edge_min)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            break
+        labels = updated
+
+    clusters = pd.DataFrame({'animal_id': ids, 'identity_id': ids[labels]})
+    clusters['cluster_size'] = clusters.groupby('identity_id')['animal_id'].transform('size')
+    return clusters
+
+def link_animal_records(intake_df, outcome_df, threshold = 3.0, window = 10) -> tuple:
+    header()
+    print('Beginning record linkage across animal_ids')
+    records = linkage_records(intake_df, outcome_df)
+    scored = score_pairs(records, candidate_pairs(records, window))
+    links = scored[scored['score'] >= threshold]
+    clusters = link_clusters(records['animal_id'], links)
+
+    linked = clusters[clusters['cluster_size'] > 1]
+    print(f'...{len(links)} links, {linked["identity_id"].nunique()} identities spanning {len(linked)} animal_ids')
+    print('...complete')
+    return scored, clusters
+
+def first_match_lookup(groups) -> dict:
+    # value -> label, keeping the first group a value appears in (same precedence as np.select)
+    lookup = {}
+    for values, label in groups:
+        for value in values:
+            lookup.setdefault(value, label)
+    return lookup
+
+INTAKE_REASON_LOOKUP = first_match_lookup([
+    (MEDICAL_CONDITIONS + REPRODUCTIVE_CONDITIONS, 'medical'),
+    (BEHAVIOR_CONDITIONS, 'behavior'),
+    (ROUTINE_CONDITIONS, 'routine')
+])
+OUTCOME_CATEGORY_LOOKUP = first_match_lookup([
+    (UNKNOWN_OUTCOMES, 'unknown'),
+    (ALIVE_OUTCOMES, 'alive'),
+    (ADMINISTRATIVE_OUTCOMES, 'admin'),
+    (DECEASED_OUTCOMES, 'deceased')
+])
+OUTCOME_SUBCATEGORY_LOOKUP = first_match_lookup([
+    (LOCATION_SUBTYPES, 'location'),
+    (BEHAVIOR_SUBTYPES, 'behavior'),
+    (PROGRAM_SUBTYPES, 'program'),
+    (ADMIN_SUBTYPES, 'admin'),
+    (UNKNOWN_SUBTYPES, 'unknown')
+])
+SEASON_LOOKUP = {month: season for season, months in SEASON_MONTHS.items() for month in months}
+SHIFT_LOOKUP = {hour: shift for shift, (start, end) in SHIFT_HOURS.items() for hour in range(start, end)}
+
+def parse_event_datetime(value):
+    for fmt in ('%m/%d/%Y %I:%M:%S %p', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+def clean_event_record(record, kind) -> dict:
+    """
+    Clean a single raw intake or outcome record (a dict keyed by raw CSV headers).
+
+    Row-level equivalent of create_intake_table / create_outtake_table, built on
+    the same category lists, so a streamed event gets the same columns and values
+    as the batch tables without the DataFrame overhead.
+    """
+    row = {}
+    for key, value in record.items():
+        if value is None or (isinstance(value, float) and np.isnan(value)) or value == '':
+            value = 'nan'
+        row[key.strip().lower().replace(' ', '_')] = str(value).strip().lower()
+
+    dt = parse_event_datetime(row['datetime'])
+    row['datetime'] = dt
+    row['std_date_time'] = dt.strftime('%Y-%m-%d %H:%M:%S') if dt else None
+    row['line_id'] = f'{row["animal_id"]}_{row["std_date_time"]}'
+
+    if dt is not None:
+        iso = dt.isocalendar()
+        row.update({
+            'year': dt.year, 'month': dt.month, 'day': dt.day, 'hour': dt.hour, 'minute': dt.minute,
+            'week': iso[1], 'iso_year': iso[0], 'day_of_week': dt.weekday(),
+            'weekday': dt.strftime('%A').lower(), 'is_weekend': dt.weekday() >= 5,
+            'quarter': (dt.month - 1) // 3 + 1,
+            'season': SEASON_LOOKUP[dt.month], 'shift': SHIFT_LOOKUP[dt.hour]
+        })
+        row['year_quarter'] = f'{dt.year}-Q{row["quarter"]}'
+
+    if kind == 'intake':
+        row['pregnant_o_nursing'] = row.get('intake_condition') in REPRODUCTIVE_CONDITIONS
+        row['intake_reason'] = INTAKE_REASON_LOOKUP.get(row.get('intake_condition'), 'Unknown')
+    else:
+        row['outcome_category'] = OUTCOME_CATEGORY_LOOKUP.get(row.get('outcome_type'), 'unknown')
+        row['outcome_subcategory'] = OUTCOME_SUBCATEGORY_LOOKUP.get(row.get('outcome_subtype'), 'unknown')
+    return row
+
+def new_stream_state(max_latencies = 100_000) -> dict:
+    return {
+        'open_stays': {},                     # animal_id -> {'datetime', 'animal_type', 'intake_reason'}
+        'census': defaultdict(int),           # animal_type -> animals in care
+        'los': defaultdict(lambda: [0, 0]),   # animal_type -> [completed stays, total days]
+        'unmatched_outcomes': 0,
+        'replaced_stays': 0,
+        'events': 0,
+        'latencies_us': deque(maxlen = max_latencies)
+    }
+
+def stream_state_from_tables(intake_df, outcome_df) -> dict:
+    # seed the open stays from a batch run so streaming can pick up where it left off
+    state = new_stream_state()
+    stays = create_stay_table(intake_df, outcome_df)
+    open_stays = stays.loc[~stays['event'], ['animal_id', 'datetime_intake', 'intake_reason']].merge(
+        intake_df[['animal_id', 'datetime', 'animal_type']].rename(columns = {'datetime': 'datetime_intake'}),
+        on = ['animal_id', 'datetime_intake'],
+        how = 'left'
+    ).drop_duplicates(subset = 'animal_id', keep = 'last')
+
+    for animal_id, dt, reason, animal_type in open_stays.itertuples(index = False):
+        state['open_stays'][animal_id] = {'datetime': dt.to_pydatetime(), 'animal_type': animal_type, 'intake_reason': reason}
+        state['census'][animal_type] += 1
+    print(f'...stream state seeded with {len(state["open_stays"])} open stays')
+    return state
+
+def apply_event(state, kind, record) -> dict:
+    """
+    Clean one intake/outcome event and update open stays, census and LOS in place.
+
+    Intakes open a stay (replacing one that never got an outcome); outcomes close
+    the animal's open stay and add its length of stay to the running totals.
+    """
+    start = time.perf_counter_ns()
+    event = clean_event_record(record, kind)
+    animal_id = event['animal_id']
+    open_stays = state['open_stays']
+
+    if event['datetime'] is None:
+        pass
+    elif kind == 'intake':
+        previous = open_stays.get(animal_id)
+        if previous is not None:
+            state['census'][previous['animal_type']] -= 1
+            state['replaced_stays'] += 1
+        open_stays[animal_id] = {
+            'datetime': event['datetime'],
+            'animal_type': event.get('animal_type'),
+            'intake_reason': event['intake_reason']
+        }
+        state['census'][event.get('animal_type')] += 1
+    else:
+        stay = open_stays.get(animal_id)
+        if stay is None or event['datetime'] < stay['datetime']:
+            state['unmatched_outcomes'] += 1
+        else:
+            del open_stays[animal_id]
+            state['census'][stay['animal_type']] -= 1
+            event['datetime_intake'] = stay['datetime']
+            event['length_of_stay_days'] = (event['datetime'] - stay['datetime']).days
+            totals = state['los'][stay['animal_type']]
+            totals[0] += 1
+            totals[1] += event['length_of_stay_days']
+
+    state['events'] += 1
+    state['latencies_us'].append((time.perf_counter_ns() - start) / 1000)
+    return event
+
+def census_snapshot(state, now = None) -> pd.DataFrame:
+    # in-care counts, open-stay ages and running average LOS per animal type, computed on demand
+    now = now or datetime.now()
+    open_stays = state['open_stays'].values()
+    ages = pd.DataFrame({
+        'animal_type': [stay['animal_type'] for stay in open_stays],
+        'open_days': [(now - stay['datetime']).total_seconds() / 86400 for stay in open_stays]
+    })
+    snapshot = ages.groupby('animal_type')['open_days'].agg(['median', 'max']).add_suffix('_open_days')
+    snapshot.insert(0, 'in_care', pd.Series(dict(state['census'])))
+    los = pd.DataFrame(dict(state['los']), index = ['completed_stays', 'total_days']).T
+    snapshot = snapshot.join(los, how = 'outer')
+    snapshot['avg_stay_days'] = snapshot['total_days'] / snapshot['completed_stays']
+    return snapshot.drop(columns = 'total_days')
+
+def stream_latency_report(state) -> dict:
+    latencies = np.array(state['latencies_us'])
+    if len(latencies) == 0:
+        return {}
+    return {
+        'events': state['events'],
+        'p50_us': float(np.percentile(latencies, 50)),
+        'p99_us': float(np.percentile(latencies, 99)),
+        'max_us': float(latencies.max())
+    }
+
+def queue_events(event_queue, max_batch = 100):
+    """
+    Yield (kind, record) events from an in-process queue in micro-batches.
+
+    Blocks for the first event, then drains up to max_batch more without waiting.
+    A None on the queue ends the stream.
+    """
+    while True:
+        batch = [event_queue.get()]
+        while len(batch) < max_batch:
+            try:
+                batch.append(event_queue.get_nowait())
+            except queue.Empty:
+                break
+        for item in batch:
+            if item is None:
+                return
+            yield item
+
+def tail_csv(file_name, kind, event_queue, stop, from_start = False, poll_interval = 0.05) -> None:
+    # follow a CSV that an export process appends to, putting each new row on the queue
+    with open(file_name, newline = '') as f:
+        columns = next(csv.reader([f.readline()]))
+        if not from_start:
+            f.seek(0, os.SEEK_END)
+        partial = ''
+        while not stop.is_set():
+            line = f.readline()
+            if not line:
+                time.sleep(poll_interval)
+                continue
+            partial += line
+            if not partial.endswith('\n'):
+                continue
+            values = next(csv.reader([partial]))
+            partial = ''
+            if values:
+                event_queue.put((kind, dict(zip(columns, values))))
+
+def start_tailing(files_by_kind, event_queue, from_start = False) -> threading.Event:
+    # e.g. {'intake': 'Austin_Animal_Center_Intakes.csv', 'outcome': 'Austin_Animal_Center_Outcomes.csv'}
+    stop = threading.Event()
+    for kind, file_name in files_by_kind.items():
+        threading.Thread(target = tail_csv, args = (file_name, kind, event_queue, stop, from_start), daemon = True).start()
+    return stop
+
+def run_stream(events, state, report_every = 1000) -> dict:
+    header()
+    print('Beginning streaming intake/outcome updates')
+    for kind, record in events:
+        apply_event(state, kind, record)
+        if report_every and state['events'] % report_every == 0:
+            print(f'...{state["events"]} events, {len(state["open_stays"])} in care, latency {stream_latency_report(state)}')
+    print('...stream ended')
+    print(census_snapshot(state))
+    print(stream_latency_report(state))
+    return state
+
+def group_labels(values, groups, default) -> pd.Series:
+    # label each distinct value with its group ({label: values}), first group wins as in np.select
+    lookup = first_match_lookup((members, label) for label, members in groups.items())
+    return values.map(lookup).fillna(default)
+
+def color_labels(values, patterns) -> pd.Series:
+    colors = values.where(values != 'pink', 'unknown')
+    is_patterned = colors.str.contains('|'.join(patterns), case = False, regex = True)
+    return colors.where(~is_patterned, 'patterned')
+
+'''
+Which exported column each mapping feeds, the column holding its source values,
+which rows it applies to, and how to label a set of distinct source values.
+'''
+MAPPING_DEPENDENCIES = {
+    'akc_group_breeds': {
+        'table': 'animal', 'source': 'primary_breed_outcome', 'output': 'akc_group_outcome',
+        'scope': lambda df, mapping: df['cln_spp_outcome'].str.contains('dog'),
+        'labels': lambda values, mapping: group_labels(values, mapping, 'unknown'),
+        'current': lambda: AKC_GROUP_BREEDS,
+        # akc_group is a scoring feature
+        'downstream': ['intake_scores', 'scoring_model']
+    },
+    'other_species_breeds': {
+        'table': 'animal', 'source': 'primary_breed_outcome', 'output': 'cln_spp_outcome',
+        # rows that came from animal_type 'other' carry one of the mapping's labels
+        'scope': lambda df, mapping: df['cln_spp_outcome'].isin(list(mapping) + ['unknown']),
+        'labels': lambda values, mapping: group_labels(values, mapping, 'unknown'),
+        'current': lambda: OTHER_SPECIES_BREEDS,
+        'downstream': ['avg_los_by_spp', 'intake_species', 'los_sketches', 'survival_tables', 'daily_features',
+                       'intake_scores', 'scoring_model']
+    },
+    'color_patterns': {
+        'table': 'animal', 'source': 'base_color_intake', 'output': 'cln_color_intake',
+        'scope': lambda df, mapping: pd.Series(True, index = df.index),
+        'labels': lambda values, mapping: color_labels(values, mapping),
+        'current': lambda: COLOR_PATTERNS,
+        'downstream': []
+    },
+    'intake_conditions': {
+        'table': 'intake', 'source': 'intake_condition', 'output': 'intake_reason',
+        'scope': lambda df, mapping: pd.Series(True, index = df.index),
+        # reproductive conditions count as medical reasons and also set pregnant_o_nursing
+        'labels': lambda values, mapping: group_labels(values, mapping, 'Unknown').replace('reproductive', 'medical'),
+        'extra_outputs': {
+            'pregnant_o_nursing': lambda values, mapping: values.isin(mapping.get('reproductive', []))
+        },
+        'current': lambda: {'medical': MEDICAL_CONDITIONS, 'reproductive': REPRODUCTIVE_CONDITIONS,
+                            'behavior': BEHAVIOR_CONDITIONS, 'routine': ROUTINE_CONDITIONS},
+        # predicted_* columns are scored from intake_reason
+        'downstream': ['intake_scores', 'scoring_model', 'survival_tables', 'daily_features']
+    },
+    'outcome_types': {
+        'table': 'outcome', 'source': 'outcome_type', 'output': 'outcome_category',
+        'scope': lambda df, mapping: pd.Series(True, index = df.index),
+        'labels': lambda values, mapping: group_labels(values, mapping, 'unknown'),
+        'current': lambda: {'unknown': UNKNOWN_OUTCOMES, 'alive': ALIVE_OUTCOMES,
+                            'admin': ADMINISTRATIVE_OUTCOMES, 'deceased': DECEASED_OUTCOMES},
+        # outcome_category is a scoring target, a competing risk and a daily count
+        'downstream': ['scoring_model', 'intake_scores', 'survival_tables', 'daily_features']
+    },
+    'outcome_subtypes': {
+        'table': 'outcome', 'source': 'outcome_subtype', 'output': 'outcome_subcategory',
+        'scope': lambda df, mapping: pd.Series(True, index = df.index),
+        'labels': lambda values, mapping: group_labels(values, mapping, 'unknown'),
+        'current': lambda: {'location': LOCATION_SUBTYPES, 'behavior': BEHAVIOR_SUBTYPES, 'program': PROGRAM_SUBTYPES,
+                            'admin': ADMIN_SUBTYPES, 'unknown': UNKNOWN_SUBTYPES},
+        'downstream': []
+    }
+}
+
+# outputs derived from mapped columns that recompute_exports_for_mapping_change does not rewrite itself
+DOWNSTREAM_OUTPUTS = {
+    'avg_los_by_spp': 'avg_los_by_spp.csv',
+    'intake_species': 'cln_spp in intake_table.csv (row_dimensions)',
+    'intake_scores': 'predicted_* columns in intake_table.csv (score_intakes)',
+    'scoring_model': 'the saved scoring model (load_or_train_scoring_model with retrain = True)',
+    'los_sketches': 'los_quantile_sketches.csv (build_los_sketches)',
+    'survival_tables': 'km_* and cif_* tables (create_survival_tables)',
+    'daily_features': 'daily_features/ partitions (update_daily_features into an empty directory)'
+}
+
+def apply_mapping_change(df, mapping_name, new_mapping, old_mapping = None) -> dict:
+    """
+    Rewrite only the rows of df whose mapped column changes under new_mapping.
+
+    The old and new mappings are compared on the distinct source values present
+    in the table; only rows holding a value whose label changed are touched.
+    old_mapping defaults to the mapping currently defined in this module, which
+    is what the table was built with.
+    """
+    spec = MAPPING_DEPENDENCIES[mapping_name]
+    if old_mapping is None:
+        old_mapping = spec['current']()
+
+    scope = spec['scope'](df, old_mapping)
+    source = df.loc[scope, spec['source']].astype(str)
+    distinct = pd.Series(source.unique())
+
+    # the main output first, then any columns the same mapping also drives
+    outputs = {spec['output']: spec['labels'], **spec.get('extra_outputs', {})}
+    rows = source.index[:0]
+    changed_by_output = {}
+    for column, labels in outputs.items():
+        old_labels = labels(distinct, old_mapping)
+        new_labels = labels(distinct, new_mapping)
+        differs = (old_labels != new_labels).to_numpy()
+        changed = dict(zip(distinct[differs], new_labels[differs]))
+
+        column_rows = source.index[source.isin(list(changed))]
+        if column == spec['output']:
+            previous = df.loc[column_rows, column].copy()
+        df.loc[column_rows, column] = source.loc[column_rows].map(changed)
+        changed_by_output[column] = changed
+        rows = rows.union(column_rows)
+        print(f'...{mapping_name}: {len(changed)} source values changed, {len(column_rows)} rows of {column} rewritten')
+
+    return {
+        'changed_values': changed_by_output[spec['output']],
+        'changed_by_output': changed_by_output,
+        'rows': rows,
+        'previous': previous,
+        'spec': spec
+    }
+
+def refresh_avg_los_by_spp(avg_los, animal_df, los_df, species) -> pd.DataFrame:
+    # recompute only the given species' rows of the sql/avg_los_by_spp.sql output
+    species = list(species)
+    animals = animal_df.loc[animal_df['cln_spp_outcome'].isin(species), ['animal_id', 'cln_spp_outcome']]
+    updated = (animals.merge(los_df[['animal_id', 'length_of_stay_days']], on = 'animal_id')
+               .groupby('cln_spp_outcome')['length_of_stay_days'].mean()
+               .rename('avg_stay_days').reset_index())
+    avg_los = pd.concat([avg_los[~avg_los['cln_spp_outcome'].isin(species)], updated], ignore_index = True)
+    return avg_los.sort_values('avg_stay_days', ascending = False).reset_index(drop = True)
+
+def recompute_exports_for_mapping_change(mapping_name, new_mapping, old_mapping = None, directory = '.', scoring_model = None) -> dict:
+    """
+    Apply a mapping edit to the exported CSV tables without a full pipeline run.
+
+    Only the table the mapping feeds is read and rewritten (and only if a row
+    changed); downstream aggregates listed for the mapping are refreshed for the
+    affected groups only. Intake predictions are rescored for rewritten intake rows
+    when a scoring_model is given. Every other dependent output is reported as
+    stale (and listed in result['stale']) until the next full run. Remember to
+    make the same edit to the mapping constant in this file so that run agrees.
+    """
+    header()
+    print(f'Beginning dependency-aware recompute for {mapping_name}')
+    start = time.perf_counter()
+    spec = MAPPING_DEPENDENCIES[mapping_name]
+    file_names = {'animal': 'animal_table.csv', 'intake': 'intake_table.csv', 'outcome': 'outcome_table.csv'}
+    table_path = os.path.join(directory, file_names[spec['table']])
+
+    df = pd.read_csv(table_path, low_memory = False, keep_default_na = False)
+    result = apply_mapping_change(df, mapping_name, new_mapping, old_mapping)
+    refreshed = []
+    if len(result['rows']) > 0:
+        avg_los_path = os.path.join(directory, 'avg_los_by_spp.csv')
+        if 'avg_los_by_spp' in spec['downstream'] and os.path.exists(avg_los_path):
+            species = set(result['previous']) | set(result['changed_values'].values())
+            los = pd.read_csv(os.path.join(directory, 'length_of_stay_table.csv'))
+            refresh_avg_los_by_spp(pd.read_csv(avg_los_path), df, los, species).to_csv(avg_los_path, index = False)
+            refreshed.append('avg_los_by_spp')
+            print(f'...avg_los_by_spp refreshed for {sorted(species)}')
+
+        # only intake-table mappings can be rescored here; animal-table ones feed scoring through the constants
+        if 'intake_scores' in spec['downstream'] and 'predicted_outcome_category' in df.columns and scoring_model is not None:
+            rows = result['rows']
+            # blanks were kept as strings when reading; score them as missing, as the batch run does
+            scored = score_intakes(df.loc[rows].replace('', np.nan), scoring_model)
+            predicted = [c for c in scored.columns if c.startswith('predicted_')]
+            df.loc[rows, predicted] = scored[predicted]
+            refreshed.append('intake_scores')
+            print(f'...predictions rescored for {len(rows)} rows')
+        df.to_csv(table_path, index = False)
+
+        result['stale'] = [dependent for dependent in spec['downstream'] if dependent not in refreshed]
+        for dependent in result['stale']:
+            print(f'...STALE after {mapping_name} change: {DOWNSTREAM_OUTPUTS[dependent]}')
+    else:
+        result['stale'] = []
+
+    print(f'...complete in {time.perf_counter() - start:.3f}s')
+    return result
+
+LIFECYCLE_ORDER = ['juvenile', 'young adult', 'adult', 'senior']
+
+def rank_cells(group_codes, target_codes, counts, target_sort_keys, ties) -> tuple:
+    """
+    Rank (group, target, count) cells within each group by count, highest first.
+
+    ties follows SQL: 'rank' = RANK() (ties share a rank, then gaps), 'dense' =
+    DENSE_RANK(), 'first' = ROW_NUMBER() with ties broken by target value.
+    target_sort_keys gives each target code's position in sorted order. Returns the
+    cell order (by group, rank, target) and the ranks in that order.
+    """
+    order = np.lexsort((target_sort_keys[target_codes], -counts, group_codes))
+    groups, values = group_codes[order], counts[order]
+
+    n = len(order)
+    position = np.arange(n)
+    group_start = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    group_id = np.cumsum(np.r_[True, groups[1:] != groups[:-1]]) - 1
+    row_number = position - group_start[group_id] + 1
+
+    if ties == 'first':
+        return order, row_number
+    new_value = np.r_[True, (groups[1:] != groups[:-1]) | (values[1:] != values[:-1])]
+    if ties == 'rank':
+        first_of_value = np.maximum.accumulate(np.where(new_value, position, 0))
+        return order, first_of_value - group_start[group_id] + 1
+    if ties == 'dense':
+        dense = np.cumsum(new_value)
+        return order, dense - dense[group_start[group_id]] + 1
+    raise ValueError(f'unknown ties rule "{ties}", use rank, dense or first')
+
+def top_k_per_group(df, group_cols, target, k = 3, ties = 'rank', sort_orders = None, count_name = 'num', max_dense_cells = 50_000_000) -> pd.DataFrame:
+    """
+    Count `target` values within each group and keep the k most frequent, in one grouped pass.
+
+    Generalizes sql/outcome_type_by_spp_by_lifestage.sql (count -> RANK() -> rnk <= k)
+    to any group-by dimensions and target column. Rows are reduced to integer
+    codes and counted with a single bincount; when the group x target matrix is
+    small enough, np.partition finds each group's k-th largest count so only
+    cells that can make the cut are ranked.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Row-level table, already filtered to the rows of interest. Group and
+        target columns may be object or Categorical.
+    group_cols : list of str
+        Dimensions to rank within (PARTITION BY).
+    target : str
+        Categorical column whose values are counted and ranked.
+    k : int
+        Rank cutoff; with ties = 'rank' or 'dense' more than k rows can be kept.
+    ties : str
+        'rank', 'dense' or 'first' (see rank_cells).
+    sort_orders : dict, optional
+        Explicit value order for group columns, e.g. {'lifestage': LIFECYCLE_ORDER};
+        unlisted values sort after listed ones.
+
+    Returns
+    -------
+    pandas.DataFrame
+        group_cols, target, count_name and 'rnk', sorted by the groups, rank,
+        count (descending) and target.
+    """
+    # observed = True keeps size() rows aligned with ngroup() codes for Categorical group columns
+    grouper = df.groupby(group_cols, sort = False, dropna = False, observed = True)
+    group_codes = grouper.ngroup().to_numpy()
+    group_labels = grouper.size().reset_index()[group_cols]
+    target_codes, target_labels = pd.factorize(df[target], use_na_sentinel = False)
+    target_labels = np.asarray(target_labels, dtype = object)
+    n_groups, n_targets = len(group_labels), len(target_labels)
+
+    cell_counts = np.bincount(group_codes * n_targets + target_codes, minlength = n_groups * n_targets)
+    if ties != 'dense' and k < n_targets and n_groups * n_targets <= max_dense_cells:
+        # k-th largest count per group; only cells at or above it can have rank <= k
+        matrix = cell_counts.reshape(n_groups, n_targets)
+        kth = np.partition(matrix, n_targets - k, axis = 1)[:, n_targets - k]
+        candidates = np.flatnonzero((matrix >= kth[:, None]).ravel() & (cell_counts > 0))
+    else:
+        candidates = np.flatnonzero(cell_counts)
+
+    cell_group, cell_target = np.divmod(candidates, n_targets)
+    target_sort_keys = pd.Series(target_labels).rank(method = 'first', na_option = 'bottom').to_numpy(dtype = np.int64)
+    order, ranks = rank_cells(cell_group, cell_target, cell_counts[candidates], target_sort_keys, ties)
+    keep = ranks <= k
+    cells = order[keep]
+
+    result = group_labels.iloc[cell_group[cells]].reset_index(drop = True)
+    result[target] = target_labels[cell_target[cells]]
+    result[count_name] = cell_counts[candidates][cells]
+    result['rnk'] = ranks[keep]
+
+    sort_cols, ascending = [], []
+    for column in group_cols:
+        if sort_orders and column in sort_orders:
+            position = {value: i for i, value in enumerate(sort_orders[column])}
+            result[f'_{column}_order'] = result[column].astype(object).map(position).fillna(len(position)).astype(int)
+            sort_cols.append(f'_{column}_order')
+        sort_cols.append(column)
+    sort_cols += ['rnk', count_name, target]
+    ascending = [True] * (len(sort_cols) - 2) + [False, True]
+    result = result.sort_values(sort_cols, ascending = ascending, kind = 'stable')
+    return result.drop(columns = [c for c in result.columns if c.startswith('_')]).reset_index(drop = True)
+
+def outcome_rank_frame(animal_df, outcome_df) -> pd.DataFrame:
+    # outcome rows with the animal dimensions, joined the way the sql/ queries do (on lower(animal_id))
+    animal = animal_df.assign(animal_key = animal_df['animal_id'].astype(str).str.lower())
+    outcome = outcome_df.assign(animal_key = outcome_df['animal_id'].astype(str).str.lower())
+    joined = animal.drop(columns = 'animal_id').merge(outcome, on = 'animal_key')
+    return joined.rename(columns = {
+        'cln_spp_outcome': 'spp',
+        'lifecycle_stage_outcome': 'lifestage',
+        'akc_group_outcome': 'akc_group',
+        'outcome_type': 'outcome'
+    })
+
+def outcome_by_spp_by_lifestage(animal_df, outcome_df, k = 3) -> pd.DataFrame:
+    # same output as sql/outcome_type_by_spp_by_lifestage.sql (csv/outcome_by_spp_by_lifestage.csv)
+    df = outcome_rank_frame(animal_df, outcome_df)
+    df = df[df['spp'].isin(['dog', 'cat']) & (df['lifestage'] != 'unknown')]
+    return top_k_per_group(df, ['spp', 'lifestage'], 'outcome', k = k, sort_orders = {'lifestage': LIFECYCLE_ORDER})
 
 
 
@@ -877,7 +2441,14 @@ Body
 
 '''
 
+SAMPLE_FRACTION = None  # e.g. 0.01 for a fast development run on a deterministic 1% of animals
+SAMPLE_SEED = 0
+SCORING_MODEL_FILE = sample_artifact_name('intake_scoring_model.npz', SAMPLE_FRACTION, SAMPLE_SEED)
+
 intake_raw, outcome_raw = load_raw_tables()
+sample_scaling = None
+if SAMPLE_FRACTION:
+    intake_raw, outcome_raw, sample_scaling = sample_raw_tables(intake_raw, outcome_raw, SAMPLE_FRACTION, stratify = True, seed = SAMPLE_SEED)
 intake = create_intake_table(intake_raw)
 outcome = create_outtake_table(outcome_raw)
 animal = create_animal_table(intake, outcome)
@@ -899,6 +2470,26 @@ outcome = drop_dimension_columns(outcome)
 los_table = clean_los_table(los_table)
 
 intake = reorder_columns(intake, ['line_id', 'animal_id', 'datetime'])
+# species and life stage at intake, so animals still in care can be filtered by them downstream
+intake[['cln_spp', 'lifecycle_stage']] = row_dimensions(intake)[['cln_spp', 'lifecycle_stage']]
+
+los_sketches = build_los_sketches(los_table, animal)
+survival_tables = create_survival_tables(intake, outcome)
+
+scoring_model = load_or_train_scoring_model(SCORING_MODEL_FILE, intake, outcome)
+intake = score_intakes(intake, scoring_model)
+event_log = build_event_log(intake, outcome)
+identity_pairs, identity_clusters = link_animal_records(intake, outcome)
+top_outcomes = outcome_by_spp_by_lifestage(animal, outcome)
+if sample_scaling is not None:
+    header()
+    print(f'Sampled run: counts are from {SAMPLE_FRACTION:.2%} of animals, *_scaled columns estimate full-history counts per species')
+    print(sample_scaling)
+    top_outcomes = scale_by_species(top_outcomes, ['num'], sample_scaling, spp_col = 'spp')
+    survival_tables['km_medians'] = scale_by_species(survival_tables['km_medians'], ['n_stays', 'n_open'], sample_scaling)
+    survival_tables['km_curves'] = scale_by_species(survival_tables['km_curves'], ['n_at_risk', 'events', 'censored'], sample_scaling)
+    print('LOS sketch weights are sampled stays (percentiles are unaffected); estimated full-history stays:')
+    print(scale_by_species(los_sketches.groupby('cln_spp', as_index = False)['weight'].sum(), ['weight'], sample_scaling))
 
 '''print('\n\n\n CURRENT INTAKE TABLE: ')
 print(intake.head(25))
@@ -913,4 +2504,16 @@ print(intake.columns)
 print(outcome.columns)
 print(animal.columns)
 print(los_table.columns)
-#export_tables(intake, outcome, animal, los_table)'''
\ No newline at end of file
+#export_tables(intake, outcome, animal, los_table)
+#los_sketches.to_csv('los_quantile_sketches.csv', index = False)
+#for name, table in survival_tables.items():
+#    table.to_csv(f'{name}.csv', index = False)
+#update_daily_features(sample_artifact_name('daily_features', SAMPLE_FRACTION, SAMPLE_SEED), intake, outcome)
+#save_event_log(event_log, 'event_log')
+#identity_clusters.to_csv('animal_identity_clusters.csv', index = False)
+#top_outcomes.to_csv('outcome_by_spp_by_lifestage.csv', index = False)
+
+#streaming mode: seed open stays from this run, then follow the raw exports as rows are appended
+#event_queue = queue.Queue()
+#stop_tailing = start_tailing({'intake': 'Austin_Animal_Center_Intakes.csv', 'outcome': 'Austin_Animal_Center_Outcomes.csv'}, event_queue)
+#stream_state = run_stream(queue_events(event_queue), stream_state_from_tables(intake, outcome))'''
\ No newline at end of file
@@ -0,0 +1,355 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+'''
+Local read-only query service over the exported pipeline tables.
+
+Tables are loaded once, sorted by date and indexed by species / life stage /
+category so a filtered aggregate only touches the matching rows. Exported
+aggregate tables (Kaplan-Meier medians, top outcomes) are served as filtered rows. Responses are
+cached (LRU with a TTL) and the whole cache is dropped whenever the exported
+CSVs change on disk, i.e. when a new pipeline run lands.
+
+Run with:  python query_service.py --data-dir <folder with exported csvs>
+Example:   curl 'http://127.0.0.1:8765/los?species=dog&stage=adult&start=2020-01-01&end=2021-01-01'
+'''
+
+TABLE_FILES = {
+    'intake': 'intake_table.csv',
+    'outcome': 'outcome_table.csv',
+    'animal': 'animal_table.csv',
+    'los': 'length_of_stay_table.csv'
+}
+
+# aggregate outputs are optional: served when the pipeline run exported them
+AGGREGATE_FILES = {
+    'survival': ('km_medians.csv', {
+        'species': 'cln_spp',
+        'stage': 'lifecycle_stage',
+        'intake_reason': 'intake_reason',
+        'year': 'year'
+    }),
+    'top_outcomes': ('outcome_by_spp_by_lifestage.csv', {
+        'species': 'spp',
+        'stage': 'lifestage'
+    })
+}
+
+FILTER_PARAMS = {
+    'species': 'cln_spp',
+    'stage': 'lifecycle_stage',
+    'outcome_category': 'outcome_category',
+    'intake_reason': 'intake_reason'
+}
+
+def header():
+    print('\n')
+    print('*' * 30)
+
+def table_mtimes(data_dir) -> dict:
+    mtimes = {}
+    for name, file_name in TABLE_FILES.items():
+        path = os.path.join(data_dir, file_name)
+        mtimes[name] = os.path.getmtime(path) if os.path.exists(path) else None
+    for name, (file_name, _) in AGGREGATE_FILES.items():
+        path = os.path.join(data_dir, file_name)
+        mtimes[name] = os.path.getmtime(path) if os.path.exists(path) else None
+    return mtimes
+
+def load_tables(data_dir) -> dict:
+    header()
+    print(f'Beginning to load pipeline outputs from {data_dir}')
+    tables = {}
+    for name, file_name in TABLE_FILES.items():
+        tables[name] = pd.read_csv(os.path.join(data_dir, file_name), low_memory = False)
+        print(f'...{name}: {len(tables[name])} rows')
+
+    animal = (tables['animal'][['animal_id', 'cln_spp_outcome', 'lifecycle_stage_outcome']]
+              .rename(columns = {'cln_spp_outcome': 'cln_spp', 'lifecycle_stage_outcome': 'lifecycle_stage'}))
+
+    intake = tables['intake']
+    intake['datetime'] = pd.to_datetime(intake['datetime'], errors = 'coerce')
+    if 'cln_spp' in intake.columns:
+        # species and stage at intake, so animals still in care are found under their species
+        intake_dims = intake[['animal_id', 'datetime', 'cln_spp', 'lifecycle_stage']]
+        intakes = intake
+    else:
+        # exports from before the intake table carried them: fall back to the outcome side
+        intake_dims = intake[['animal_id', 'datetime']].merge(animal, on = 'animal_id', how = 'left')
+        intakes = intake.merge(animal, on = 'animal_id', how = 'left')
+    intake_dims = (intake_dims.drop_duplicates(subset = ['animal_id', 'datetime'])
+                   .rename(columns = {'datetime': 'datetime_intake'}))
+
+    outcome = tables['outcome']
+    outcome['datetime'] = pd.to_datetime(outcome['datetime'], errors = 'coerce')
+    los = tables['los']
+    for column in ['datetime_intake', 'datetime_outcome']:
+        los[column] = pd.to_datetime(los[column], errors = 'coerce')
+    los = los.merge(
+        outcome[['animal_id', 'datetime', 'outcome_category']].rename(columns = {'datetime': 'datetime_outcome'}),
+        on = ['animal_id', 'datetime_outcome'],
+        how = 'left'
+    )
+
+    facts = {
+        'intakes': (intakes, 'datetime'),
+        'outcomes': (outcome.merge(animal, on = 'animal_id', how = 'left'), 'datetime'),
+        'los': (los.merge(intake_dims, on = ['animal_id', 'datetime_intake'], how = 'left'), 'datetime_intake')
+    }
+    indexes = {name: build_index(df, date_col) for name, (df, date_col) in facts.items()}
+
+    indexes['aggregates'] = {}
+    for name, (file_name, _) in AGGREGATE_FILES.items():
+        path = os.path.join(data_dir, file_name)
+        if os.path.exists(path):
+            indexes['aggregates'][name] = pd.read_csv(path)
+            print(f'...{name}: {len(indexes["aggregates"][name])} rows')
+    print('...complete')
+    return indexes
+
+def build_index(df, date_col) -> dict:
+    """
+    Sort a table by date and index its filter columns.
+
+    Each filter column maps value -> sorted row positions, so a query intersects
+    a few small position arrays and narrows the date range with a binary search.
+    """
+    df = df.dropna(subset = [date_col]).sort_values(date_col).reset_index(drop = True)
+    index = {
+        'df': df,
+        'dates': df[date_col].to_numpy(),
+        'positions': {}
+    }
+    for column in FILTER_PARAMS.values():
+        if column not in df.columns:
+            continue
+        values = df[column].astype(str).str.lower().to_numpy()
+        order = np.argsort(values, kind = 'stable')
+        uniques, starts = np.unique(values[order], return_index = True)
+        bounds = np.r_[starts, len(values)]
+        index['positions'][column] = {
+            value: order[bounds[i]:bounds[i + 1]] for i, value in enumerate(uniques)
+        }
+    return index
+
+def select_rows(index, params) -> pd.DataFrame:
+    dates = index['dates']
+    low = np.searchsorted(dates, np.datetime64(params['start'])) if 'start' in params else 0
+    high = np.searchsorted(dates, np.datetime64(params['end'])) if 'end' in params else len(dates)
+
+    rows = None
+    for param, column in FILTER_PARAMS.items():
+        if param not in params:
+            continue
+        if column not in index['positions']:
+            raise ValueError(f'filter "{param}" is not available for this table')
+        positions = index['positions'][column].get(params[param].lower(), np.empty(0, dtype = int))
+        rows = positions if rows is None else np.intersect1d(rows, positions, assume_unique = True)
+
+    if rows is None:
+        return index['df'].iloc[low:high]
+    rows = rows[(rows >= low) & (rows < high)]
+    return index['df'].iloc[np.sort(rows)]
+
+def counts_by(df, column) -> dict:
+    return {str(k): int(v) for k, v in df[column].value_counts().items()}
+
+def query_los(indexes, params) -> dict:
+    rows = select_rows(indexes['los'], params)
+    days = rows['length_of_stay_days'].dropna().to_numpy()
+    if len(days) == 0:
+        return {'count': 0}
+    p50, p90 = np.percentile(days, [50, 90])
+    return {
+        'count': int(len(days)),
+        'mean_days': float(days.mean()),
+        'median_days': float(p50),
+        'p90_days': float(p90),
+        'max_days': float(days.max())
+    }
+
+def query_outcomes(indexes, params) -> dict:
+    rows = select_rows(indexes['outcomes'], params)
+    return {
+        'count': int(len(rows)),
+        'by_outcome_category': counts_by(rows, 'outcome_category'),
+        'by_outcome_type': counts_by(rows, 'outcome_type')
+    }
+
+def query_intakes(indexes, params) -> dict:
+    rows = select_rows(indexes['intakes'], params)
+    return {
+        'count': int(len(rows)),
+        'by_intake_reason': counts_by(rows, 'intake_reason'),
+        'by_season': counts_by(rows, 'season'),
+        'by_shift': counts_by(rows, 'shift')
+    }
+
+def query_aggregate(indexes, name, params) -> dict:
+    # aggregate tables are small, so a filtered read is a plain boolean mask
+    file_name, filters = AGGREGATE_FILES[name]
+    if name not in indexes['aggregates']:
+        raise ValueError(f'{file_name} was not exported by the last pipeline run')
+    df = indexes['aggregates'][name]
+    mask = np.ones(len(df), dtype = bool)
+    for param, column in filters.items():
+        if param in params:
+            mask &= (df[column].astype(str).str.lower() == params[param].lower()).to_numpy()
+    rows = df[mask]
+    return {
+        'count': int(len(rows)),
+        'rows': rows.astype(object).where(rows.notna(), None).to_dict(orient = 'records')
+    }
+
+def query_survival(indexes, params) -> dict:
+    return query_aggregate(indexes, 'survival', params)
+
+def query_top_outcomes(indexes, params) -> dict:
+    return query_aggregate(indexes, 'top_outcomes', params)
+
+ROUTES = {
+    '/los': query_los,
+    '/outcomes': query_outcomes,
+    '/intakes': query_intakes,
+    '/survival': query_survival,
+    '/top_outcomes': query_top_outcomes
+}
+
+class ResponseCache:
+    '''LRU cache of serialized responses; entries expire after ttl seconds.'''
+
+    def __init__(self, max_entries = 1024, ttl = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+
+    def clear(self):
+        self.entries.clear()
+
+class QueryService:
+    def __init__(self, data_dir, max_entries = 1024, ttl = 300, reload_interval = 5):
+        self.data_dir = data_dir
+        self.reload_interval = reload_interval
+        self.cache = ResponseCache(max_entries, ttl)
+        self.mtimes = table_mtimes(data_dir)
+        self.indexes = load_tables(data_dir)
+
+    async def watch_for_new_run(self):
+        # a new pipeline run rewrites the exported csvs; reload and drop every cached response
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            mtimes = table_mtimes(self.data_dir)
+            if mtimes != self.mtimes:
+                print('Pipeline outputs changed, reloading tables and clearing cache')
+                try:
+                    self.indexes = await asyncio.to_thread(load_tables, self.data_dir)
+                    self.mtimes = mtimes
+                    self.cache.clear()
+                except (OSError, KeyError, ValueError) as e:
+                    # files may still be mid-write; try again on the next tick
+                    print(f'ERROR reloading tables: {e}')
+
+    def respond(self, target):
+        url = urlsplit(target)
+        if url.path == '/health':
+            return 200, json.dumps({
+                'status': 'ok',
+                'cached_entries': len(self.cache.entries),
+                'cache_hits': self.cache.hits,
+                'cache_misses': self.cache.misses
+            })
+        if url.path not in ROUTES:
+            return 404, json.dumps({'error': f'unknown path {url.path}', 'paths': sorted(ROUTES)})
+
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        key = (url.path, tuple(sorted(params.items())))
+        body = self.cache.get(key)
+        if body is None:
+            try:
+                body = json.dumps(ROUTES[url.path](self.indexes, params))
+            except ValueError as e:
+                return 400, json.dumps({'error': str(e)})
+            self.cache.put(key, body)
+        return 200, body
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                keep_alive = True
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'connection' and value.strip().lower() == 'close':
+                        keep_alive = False
+
+                if method != 'GET':
+                    status, body = 405, json.dumps({'error': 'read-only service, use GET'})
+                else:
+                    status, body = self.respond(target)
+
+                payload = body.encode()
+                reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}[status]
+                writer.write(
+                    f'HTTP/1.1 {status} {reason}\r\n'
+                    f'Content-Type: application/json\r\n'
+                    f'Content-Length: {len(payload)}\r\n'
+                    f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(data_dir, host = '127.0.0.1', port = 8765, max_entries = 1024, ttl = 300):
+    service = QueryService(data_dir, max_entries, ttl)
+    server = await asyncio.start_server(service.handle, host, port)
+    print(f'Serving pipeline aggregates on http://{host}:{port} ({", ".join(sorted(ROUTES))}, /health)')
+    asyncio.create_task(service.watch_for_new_run())
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Serve filtered aggregates over exported pipeline tables.')
+    parser.add_argument('--data-dir', default = '.')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--cache-size', type = int, default = 1024)
+    parser.add_argument('--ttl', type = float, default = 300)
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.data_dir, args.host, args.port, args.cache_size, args.ttl))
@@ -0,0 +1,78 @@
+import asyncio
+import random
+import time
+
+import numpy as np
+
+'''
+Load test for query_service.py. Start the service first, then run:
+
+    python query_service_load_test.py --requests 5000 --concurrency 32
+
+Each client keeps one keep-alive connection open and sends a random mix of
+filtered queries, so both cache hits and misses are exercised.
+'''
+
+SPECIES = ['dog', 'cat', 'bird', 'rabbit', 'wildlife', 'rodent_small_pet']
+STAGES = ['juvenile', 'young adult', 'adult', 'senior']
+CATEGORIES = ['alive', 'admin', 'deceased', 'unknown']
+YEARS = list(range(2014, 2026))
+
+def random_target() -> str:
+    path = random.choice(['/los', '/outcomes', '/intakes'])
+    params = [f'species={random.choice(SPECIES)}']
+    if random.random() < 0.6:
+        params.append(f'stage={random.choice(STAGES).replace(" ", "+")}')
+    if path == '/outcomes' and random.random() < 0.3:
+        params.append(f'outcome_category={random.choice(CATEGORIES)}')
+    if random.random() < 0.5:
+        year = random.choice(YEARS)
+        params.append(f'start={year}-01-01&end={year + 1}-01-01')
+    return f'{path}?{"&".join(params)}'
+
+async def client(host, port, n_requests, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    for _ in range(n_requests):
+        request = f'GET {random_target()} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode()
+        start = time.perf_counter()
+        writer.write(request)
+        await writer.drain()
+
+        content_length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            if line.lower().startswith(b'content-length:'):
+                content_length = int(line.split(b':', 1)[1])
+        await reader.readexactly(content_length)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+async def run(host, port, n_requests, concurrency):
+    latencies = []
+    per_client = max(1, n_requests // concurrency)
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, per_client, latencies) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    ms = np.array(latencies) * 1000
+    print(f'{len(ms)} requests in {elapsed:.2f}s ({len(ms) / elapsed:.0f} req/s, concurrency {concurrency})')
+    print(f'p50: {np.percentile(ms, 50):.2f} ms')
+    print(f'p90: {np.percentile(ms, 90):.2f} ms')
+    print(f'p99: {np.percentile(ms, 99):.2f} ms')
+    print(f'max: {ms.max():.2f} ms')
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Report p50/p99 latency of the local query service.')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--requests', type = int, default = 5000)
+    parser.add_argument('--concurrency', type = int, default = 32)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    asyncio.run(run(args.host, args.port, args.requests, args.concurrency))